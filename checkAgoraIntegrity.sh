@@ -45,6 +45,70 @@ extractGeneFamiliesCommandLines=(
 )
 print_and_run_commands "${extractGeneFamiliesCommandLines[@]}"
 
+# In parallel, the index of the forest is only written where -index says
+parallelExtractGeneFamiliesCommandLines=(
+"src/ALL.extractGeneFamilies.py example/data/Species.nwk example/data/GeneTreeForest.nhx.bz2 -OUT.ancGenesFiles=tmp/ancGenes/parallel/ancGenes.%s.list.bz2 -nbThreads=2 > tmp/geneTrees.afterExtractingAncGenes.parallel.protTree"
+"src/ALL.extractGeneFamilies.py example/data/Species.nwk example/data/GeneTreeForest.nhx.bz2 -OUT.ancGenesFiles=tmp/ancGenes/parallel/ancGenes.%s.list.bz2 -nbThreads=2 -index=tmp/GeneTreeForest.idx > tmp/geneTrees.afterExtractingAncGenes.parallel.protTree"
+"cmp tmp/geneTrees.afterExtractingAncGenes.protTree tmp/geneTrees.afterExtractingAncGenes.parallel.protTree"
+)
+print_and_run_commands "${parallelExtractGeneFamiliesCommandLines[@]}"
+
+if [ -e example/data/GeneTreeForest.nhx.bz2.idx ] || [ ! -e tmp/GeneTreeForest.idx ]
+    then
+        error 'The index of the forest has not been written where -index says'
+fi
+
+##################################################
+#	Check the outputs of the workflow tasks      #
+##################################################
+print_title 'check that the outputs of the workflow tasks can be read back'
+
+# With and without parallel compression (AGORA_COMPRESSION_THREADS)
+for threads in 1 4
+do
+    printf "${green}AGORA_COMPRESSION_THREADS=${threads}${NC}\n"
+    AGORA_COMPRESSION_THREADS=${threads} PYTHONPATH=src python3 - <<'EOF' || error 'The output of a task cannot be read back'
+import utils.myAgoraWorkflow
+import utils.myFile
+for ext in ["", ".bz2", ".gz", ".xz"]:
+    out = "tmp/runCommand/seq.txt" + ext
+    command = utils.myAgoraWorkflow.Command(["seq", "100000"], out, "tmp/runCommand/seq.log")
+    assert utils.myAgoraWorkflow.runCommand(command, {}, "seq") == 0, out
+    f = utils.myFile.openFile(out, "r")
+    assert f.read().split() == [str(i) for i in range(1, 100001)], out
+    f.close()
+EOF
+done
+
+##################################################
+#	Check the genome cache of -backend=inprocess #
+##################################################
+print_title 'check that Genome.load leaves the cached genomes unchanged'
+
+mkdir -p tmp/genomeCache
+PYTHONPATH=src python3 - <<'EOF' || error 'Genome.load has changed a cached genome'
+import os
+import utils.myAgoraWorkflow
+script = os.path.abspath("tmp/genomeCache/check.py")
+with open(script, "w") as f:
+    print("""
+import utils.myGenomes
+path = "example/data/genes/genes.M1.list.bz2"
+genome = utils.myGenomes.Genome(path)
+utils.myGenomes.Genome.load(path, cache_dir="tmp/genomeCache", names=utils.myGenomes.GeneNameRegistry())
+assert utils.myGenomes.Genome(path) is genome
+assert all(isinstance(s, str) for l in genome.lstGenes.values() for gene in l for s in gene.names)
+""", file=f)
+worker = utils.myAgoraWorkflow.InProcessWorker()
+try:
+    # Once with the genome not in the cache directory yet, once with it
+    for _ in range(2):
+        (r, _, _) = worker.run(utils.myAgoraWorkflow.Command([script], None, "tmp/genomeCache/check.log"))
+        assert r == 0, open("tmp/genomeCache/check.log").read()
+finally:
+    worker.stop()
+EOF
+
 #########################################
 #	Check integrity of agora.py		    #
 #########################################
@@ -76,6 +140,23 @@ print_title 'output verification'
 
 print_and_run_commands "${verifCommandLines[@]}"
 
+#########################################################
+#	Check the incremental re-execution of the workflow  #
+#########################################################
+print_title 'check that a second run with unchanged inputs launches no task'
+
+# This workflow also filters the blocks, whose output is a plain argument
+rerunCommandLines=(
+"src/agora-generic.py example/data/Species.nwk example/data/GeneTreeForest.nhx.bz2 example/data/genes/genes.%s.list.bz2 -workingDir=tmp/generic -nbThreads=1 > tmp/generic.log"
+"src/agora-generic.py example/data/Species.nwk example/data/GeneTreeForest.nhx.bz2 example/data/genes/genes.%s.list.bz2 -workingDir=tmp/generic -nbThreads=1 > tmp/generic.rerun.log"
+)
+print_and_run_commands "${rerunCommandLines[@]}"
+
+if grep -q '^Launching task' tmp/generic.rerun.log
+    then
+        error 'Some tasks have been relaunched although nothing has changed'
+fi
+
 echo
 printf "${green} The ancestral genomes are available in tmp/ancGenomes/vertebrates-workflow/${NC}\n"
 printf "${green} Everything seems OK! Enjoy AGORA${NC}\n"
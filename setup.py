@@ -18,6 +18,7 @@ setup(name='Agora',
           'src/ALL.filterBlocks-fixedLength.py',
           'src/ALL.filterBlocks-propLength.py',
           'src/ALL.filterGeneFamilies-size.py',
+          'src/ALL.indexGeneTrees.py',
           'src/ALL.reformatGeneFamilies.py',
           'src/ALL.selectBestReconstruction.py',
           'src/ENSEMBL.buildProteinTrees.py',
@@ -25,6 +26,7 @@ setup(name='Agora',
           'src/agora-generic.py',
           'src/agora-plants.py',
           'src/agora-vertebrates.py',
+          'src/agora-worker.py',
           'src/agora.py',
           'src/buildSynteny.integr-copy.py',
           'src/buildSynteny.integr-denovo.py',
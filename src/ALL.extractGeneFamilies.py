@@ -8,6 +8,10 @@
 
 __doc__ = """
     Read the forest of gene trees and extract the gene content of every ancestral genome in a separate file.
+    With -nbThreads, the trees are processed in parallel, using the index of
+    the forest (see ALL.indexGeneTrees.py), with the same output. The index is
+    read from the -index file if it is up to date, and otherwise built and
+    saved there (or only built in memory, without -index).
 
     Usage:
         src/ALL.extractGeneFamilies.py example/data/Species.nwk example/data/GeneTreeForest.nhx.bz2 \
@@ -15,21 +19,24 @@ __doc__ = """
 """
 
 import collections
+import heapq
+import io
+import operator
+import os
 import sys
+import tempfile
 
 import utils.myFile
 import utils.myPhylTree
 import utils.myProteinTree
 import utils.myTools
 
-sys.setrecursionlimit(10000)
-
 # Arguments
 ###########
 
 arguments = utils.myTools.checkArgs(
     [("speciesTree", utils.myTools.FileArgChecker), ("geneTrees", utils.myTools.FileArgChecker)],
-    [("OUT.ancGenesFiles", str, ""), ("reuseNames", bool, False)],
+    [("OUT.ancGenesFiles", str, ""), ("reuseNames", bool, False), ("nbThreads", int, 1), ("index", str, "")],
     __doc__
 )
 
@@ -50,17 +57,20 @@ def futureName(name, dup):
 # Find roots in families #
 #########################
 def getRoots(node, previousAnc, lastWrittenAnc):
-    newAnc = tree.info[node]['taxon_name']
-    (_, newLastWritten, isroot) = utils.myProteinTree.getIntermediateAnc(phylTree, previousAnc, lastWrittenAnc, newAnc,
-                                                                         tree.info[node]['Duplication'] >= 2)
-
-    if isroot:
-        return [node]
-
-    # descendant genes
     subRoots = []
-    for (g, _) in tree.data.get(node, []):
-        subRoots.extend(getRoots(g, newAnc, newLastWritten))
+    todo = [(node, previousAnc, lastWrittenAnc)]
+    while todo:
+        (node, previousAnc, lastWrittenAnc) = todo.pop()
+        newAnc = tree.info[node]['taxon_name']
+        (_, newLastWritten, isroot) = utils.myProteinTree.getIntermediateAnc(phylTree, previousAnc, lastWrittenAnc, newAnc,
+                                                                             tree.info[node]['Duplication'] >= 2)
+
+        if isroot:
+            subRoots.append(node)
+            continue
+
+        # descendant genes, in order
+        todo.extend((g, newAnc, newLastWritten) for (g, _) in reversed(tree.data.get(node, [])))
     return subRoots
 
 
@@ -70,43 +80,117 @@ count = collections.defaultdict(int)
 #################################
 # Backup all the gene families #
 ################################
-def extractGeneFamilies(node, baseName, previousAnc, lastWrittenAnc):
-    newAnc = tree.info[node]['taxon_name']
-    (toWrite, newLastWritten, isroot) = utils.myProteinTree.getIntermediateAnc(phylTree, previousAnc, lastWrittenAnc,
-                                                                               newAnc,
-                                                                               tree.info[node]['Duplication'] >= 2)
-
-    if isroot and (previousAnc is not None):
-        if not arguments["reuseNames"]:
-            baseName = baseName.split(".")[0]
-        count[baseName] += 1
-        currName = baseName + utils.myProteinTree.getDupSuffix(count[baseName], True)
-    else:
-        currName = baseName
-    tree.info[node]['family_name'] = currName
-
-    # descendant genes
-    if node in tree.data:
-        allGenes = []
-        for (g, _) in tree.data[node]:
-            allGenes.extend(
-                extractGeneFamilies(g, futureName(currName, tree.info[node]['Duplication']), newAnc, newLastWritten))
+def extractGeneFamilies(root, rootName):
+    # (currName, newAnc, newLastWritten, toWrite) of the nodes being walked
+    state = {}
+    # descendant genes of the nodes that have been left
+    genes = {}
+    for (node, parent, _, entering) in tree.walk(root):
+        if not entering:
+            (currName, _, _, toWrite) = state.pop(node)
+
+            # descendant genes
+            if node in tree.data:
+                allGenes = []
+                for (g, _) in tree.data[node]:
+                    allGenes.extend(genes.pop(g))
+            else:
+                allGenes = [tree.info[node]["gene_name"]]
+
+            for a in toWrite:
+                geneFamilies[a].append([currName] + allGenes)
+
+            genes[node] = allGenes
+            continue
+
+        if parent is None:
+            (baseName, previousAnc, lastWrittenAnc) = (rootName, None, None)
+        else:
+            (parentName, previousAnc, lastWrittenAnc, _) = state[parent]
+            baseName = futureName(parentName, tree.info[parent]['Duplication'])
+        newAnc = tree.info[node]['taxon_name']
+        (toWrite, newLastWritten, isroot) = utils.myProteinTree.getIntermediateAnc(phylTree, previousAnc, lastWrittenAnc,
+                                                                                   newAnc,
+                                                                                   tree.info[node]['Duplication'] >= 2)
+
+        if isroot and (previousAnc is not None):
+            if not arguments["reuseNames"]:
+                baseName = baseName.split(".")[0]
+            count[baseName] += 1
+            currName = baseName + utils.myProteinTree.getDupSuffix(count[baseName], True)
+        else:
+            currName = baseName
+        tree.info[node]['family_name'] = currName
+        state[node] = (currName, newAnc, newLastWritten, toWrite)
+
+    return genes.pop(root)
+
+
+def processTree(f):
+    extractGeneFamilies(tree.root, tree.info[tree.root]["tree_name"])
+    if tree.info[tree.root]["format"] == "NHX":
+        tree.printNewick(f, withDist=True, withTags=True, withAncSpeciesNames=True, withAncGenesNames=True)
+    elif tree.info[tree.root]["format"] == "JSON":
+        tree.printJSON(f)
     else:
-        allGenes = [tree.info[node]["gene_name"]]
-
-    for a in toWrite:
-        geneFamilies[a].append([currName] + allGenes)
-
-    return allGenes
+        tree.printTree(f)
+
+
+# The family names are numbered (count and dupCount) by the first part of the
+# name of the tree, across the trees. The trees that share it have to be in the
+# same shard, which processes them in the order of the forest
+def getShards(index, nbShards):
+    shards = [[] for _ in range(nbShards)]
+    owner = {}
+    for (i, shard) in enumerate(index.getShards(nbShards)):
+        for number in shard:
+            prefix = index.entries[number].family.split(".")[0]
+            shards[owner.setdefault(prefix, i)].append(number)
+    return [shard for shard in shards if shard]
+
+
+# Process a shard of the forest in a worker process. The annotated trees are
+# written to outName, and their sizes are returned with the families, both
+# along the number of their tree
+def extractShard(args):
+    global tree
+    (shard, outName) = args
+    count.clear()
+    dupCount.clear()
+    families = collections.defaultdict(list)
+    sizes = []
+    with open(outName, "wb") as out:
+        for (number, tree) in zip(shard, utils.myProteinTree.loadTree(arguments["geneTrees"], trees=shard, index=index)):
+            geneFamilies.clear()
+            f = io.StringIO()
+            processTree(f)
+            for (anc, lst) in geneFamilies.items():
+                families[anc].append((number, lst))
+            sizes.append((number, out.write(f.getvalue().encode())))
+    return (families, sizes)
 
 
 geneFamilies = collections.defaultdict(list)
-for tree in utils.myProteinTree.loadTree(arguments["geneTrees"]):
-    extractGeneFamilies(tree.root, tree.info[tree.root]["tree_name"], None, None)
-    if tree.info[tree.root]["format"] == "NHX":
-        tree.printNewick(sys.stdout, withDist=True, withTags=True, withAncSpeciesNames=True, withAncGenesNames=True)
-    else:
-        tree.printTree(sys.stdout)
+if (arguments["nbThreads"] > 1) and os.path.isfile(arguments["geneTrees"]):
+    index = utils.myProteinTree.ForestIndex.load(arguments["geneTrees"], arguments["index"])
+    # More shards than threads, for a better balance
+    shards = getShards(index, 2 * arguments["nbThreads"])
+    with tempfile.TemporaryDirectory() as tmpDir:
+        outNames = [os.path.join(tmpDir, "shard%d" % i) for i in range(len(shards))]
+        results = utils.myTools.dynamicPoolMap(extractShard, list(zip(shards, outNames)), arguments["nbThreads"])
+        # Merged in the order of the forest
+        outFiles = [open(outName, "rb") for outName in outNames]
+        for (_, i, size) in heapq.merge(*[[(number, i, size) for (number, size) in sizes] for (i, (_, sizes)) in enumerate(results)]):
+            sys.stdout.write(outFiles[i].read(size).decode())
+        for f in outFiles:
+            f.close()
+    geneFamilies.clear()
+    for anc in set().union(*[families for (families, _) in results]):
+        for (_, lst) in heapq.merge(*[families[anc] for (families, _) in results if anc in families], key=operator.itemgetter(0)):
+            geneFamilies[anc].extend(lst)
+else:
+    for tree in utils.myProteinTree.loadTree(arguments["geneTrees"]):
+        processTree(sys.stdout)
 
 for anc in sorted(geneFamilies):
     if anc in phylTree.listSpecies:
@@ -19,23 +19,19 @@ __doc__ = """
 import sys
 
 import utils.myFile
+import utils.myGenomes
 import utils.myTools
 import utils.myPhylTree
 from utils.myTools import file
 
-arguments = utils.myTools.checkArgs( [("speciesTree",file), ("target",str), ("IN.ancGenesFiles",str), ("OUT.ancGenesFiles",str), ("minLength",int)], [], __doc__ )
+arguments = utils.myTools.checkArgs( [("speciesTree",file), ("target",str), ("IN.ancGenesFiles",str), ("OUT.ancGenesFiles",str), ("minLength",int)], [("binaryOutput",bool,False)], __doc__ )
 
 phylTree = utils.myPhylTree.PhylogeneticTree(arguments["speciesTree"])
 targets = phylTree.getTargetsAnc(arguments["target"])
 
 for anc in sorted(targets):
-		fi = utils.myFile.openFile(arguments["IN.ancGenesFiles"] % phylTree.fileName[anc], "r")
-		fo = utils.myFile.openFile(arguments["OUT.ancGenesFiles"] % phylTree.fileName[anc], "w")
-		for l in fi:
-			if int(l.split("\t")[1]) >= arguments["minLength"]:
-				fo.write(l)
-			else:
-				print("%s\t0\t\t\t" % anc, file=fo)
-		fi.close()
-		fo.close()
+		(name, blocks) = utils.myGenomes.loadAncBlocks(arguments["IN.ancGenesFiles"] % phylTree.fileName[anc])
+		# The blocks that are too small are emptied, to keep the numbering
+		blocks = [b if len(b[0]) >= arguments["minLength"] else ([], [], []) for b in blocks]
+		utils.myGenomes.saveAncBlocks(arguments["OUT.ancGenesFiles"] % phylTree.fileName[anc], name or anc, blocks, arguments["binaryOutput"])
 
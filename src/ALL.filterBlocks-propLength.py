@@ -20,32 +20,23 @@ import sys
 import itertools
 
 import utils.myFile
+import utils.myGenomes
 import utils.myMaths
 import utils.myTools
 import utils.myPhylTree
 from utils.myTools import file
 
-arguments = utils.myTools.checkArgs( [("speciesTree",file), ("target",str), ("IN.ancGenesFiles",str), ("OUT.ancGenesFiles",str), ("minProp",int)], [], __doc__ )
+arguments = utils.myTools.checkArgs( [("speciesTree",file), ("target",str), ("IN.ancGenesFiles",str), ("OUT.ancGenesFiles",str), ("minProp",int)], [("binaryOutput",bool,False)], __doc__ )
 
 phylTree = utils.myPhylTree.PhylogeneticTree(arguments["speciesTree"])
 targets = phylTree.getTargetsAnc(arguments["target"])
 
 for anc in sorted(targets):
 
-		ls = []
-		ll = []
-		f = utils.myFile.openFile(arguments["IN.ancGenesFiles"] % phylTree.fileName[anc], "r")
-		for l in f:
-			ls.append(int(l.split("\t")[1]))
-			ll.append(l)
-		f.close()
-
-		cutoff = utils.myMaths.myStats.getValueNX(sorted(ls), arguments["minProp"])
-		f = utils.myFile.openFile(arguments["OUT.ancGenesFiles"] % phylTree.fileName[anc], "w")
-		for (s,l) in zip(ls, ll):
-			if s >= cutoff:
-				f.write(l)
-			else:
-				print("%s\t0\t\t\t" % anc, file=f)
-		f.close()
+		(name, blocks) = utils.myGenomes.loadAncBlocks(arguments["IN.ancGenesFiles"] % phylTree.fileName[anc])
+
+		cutoff = utils.myMaths.myStats.getValueNX(sorted(len(b[0]) for b in blocks), arguments["minProp"])
+		# The blocks that are too small are emptied, to keep the numbering
+		blocks = [b if len(b[0]) >= cutoff else ([], [], []) for b in blocks]
+		utils.myGenomes.saveAncBlocks(arguments["OUT.ancGenesFiles"] % phylTree.fileName[anc], name or anc, blocks, arguments["binaryOutput"])
 
@@ -39,12 +39,12 @@ for anc in sorted(phylTree.listAncestr.union(phylTree.listSpecies)):
     if phylTree.dicParents[anc][target] == target:
         ancPath = arguments["IN.ancGenesFiles"] % phylTree.fileName[anc]
         if os.path.exists(ancPath):
-            ancGenes = utils.myGenomes.Genome(arguments["IN.ancGenesFiles"] % phylTree.fileName[anc])
+            ancGenes = utils.myGenomes.Genome.load(arguments["IN.ancGenesFiles"] % phylTree.fileName[anc])
             lstAncGenes[anc] = [gene.names for gene in ancGenes.lstGenes[None]]
             del ancGenes
         elif anc in phylTree.listSpecies:
             # Use the genesFiles if ancGenesFiles don't cover extant species
-            genome = utils.myGenomes.Genome(arguments["IN.genesFiles"] % phylTree.fileName[anc])
+            genome = utils.myGenomes.Genome.load(arguments["IN.genesFiles"] % phylTree.fileName[anc])
             # Only the first "name" of each gene matters, it's the one that is expected to be used
             # in the gene trees or orthology groups. Need to add None to match the way ancestral
             # genes are usually recorded
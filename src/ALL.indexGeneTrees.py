@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# AGORA v3.1
+# python 3.5
+# Copyright © 2006-2022 IBENS/Dyogen, 2020-2021 EMBL-European Bioinformatics Institute, 2021-2022 Genome Research Ltd : Matthieu MUFFATO, Alexandra LOUIS, Thi Thuy Nga NGUYEN, Hugues ROEST CROLLIUS
+# mail : agora@bio.ens.psl.eu
+# This is free software; you may copy, modify and/or distribute this work under the terms of the GNU General Public License, version 3 or later and the CeCiLL v2 license in France
+
+__doc__ = """
+    Build the index of a forest of gene trees, which gives where each tree
+    starts, its family name, number of leaves and species, and save it in the
+    -OUT.index file (to be given to the -index option of the scripts that read
+    the forest in parallel). With -nbShards, print how to split the forest into
+    shards of consecutive trees with about the same number of leaves (shard
+    number, first tree, last tree, number of trees and of leaves)
+
+    Usage:
+        src/ALL.indexGeneTrees.py example/data/GeneTreeForest.nhx.bz2 -OUT.index=tmp/GeneTreeForest.idx
+        src/ALL.indexGeneTrees.py example/data/GeneTreeForest.nhx.bz2 -nbShards=8
+"""
+
+import utils.myFile
+import utils.myProteinTree
+import utils.myTools
+
+arguments = utils.myTools.checkArgs(
+    [("geneTrees", utils.myTools.FileArgChecker)],
+    [("OUT.index", str, ""), ("nbShards", int, 0)],
+    __doc__
+)
+
+index = utils.myProteinTree.ForestIndex(arguments["geneTrees"])
+if arguments["OUT.index"]:
+    index.save(arguments["OUT.index"])
+
+if arguments["nbShards"] > 0:
+    for (i, shard) in enumerate(index.getShards(arguments["nbShards"])):
+        print(utils.myFile.myTSV.printLine([i, shard.start, shard.stop - 1, len(shard), sum(index.entries[j].nbLeaves for j in shard)]))
@@ -19,10 +19,12 @@ __doc__ = """
                 example/results/ancBlocks/best-pass1.denovo-fixedLength-50.fillin-all.fusion-all.insertion-all.asAncGenes/blocks.%s.list.bz2
 """
 
+import shutil
 import sys
 import itertools
 
 import utils.myFile
+import utils.myGenomes
 import utils.myMaths
 import utils.myTools
 import utils.myPhylTree
@@ -40,24 +42,18 @@ targets = phylTree.getTargetsAnc(arguments["target"])
 for anc in sorted(targets):
 
     stats = {}
-    lines = {}
     for ancBlocksFileName in arguments["IN.ancBlocks"]:
-        ls = []
-        ll = []
-        f = utils.myFile.openFile(ancBlocksFileName % phylTree.fileName[anc], "r")
-        for l in f:
-            ls.append(int(l.split("\t")[1]))
-            ll.append(l)
-        f.close()
+        ls = utils.myGenomes.loadAncBlocksSizes(ancBlocksFileName % phylTree.fileName[anc])
         ls.sort()
-        lines[ancBlocksFileName] = ll
         stats[ancBlocksFileName] = utils.myMaths.myStats.getValueNX(ls, 50)
         print("%s @ %s: %s" % (anc, ancBlocksFileName, utils.myMaths.myStats.txtSummary(ls)), file=sys.stderr)
 
     bestBlocks = max(arguments["IN.ancBlocks"], key=stats.get)
     print("-> Best for %s is %s" % (anc, bestBlocks), file=sys.stderr)
 
-    fo = utils.myFile.openFile(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], "w")
-    for l in lines[bestBlocks]:
-        fo.write(l)
+    # Copied as bytes, whatever the format
+    fi = utils.myFile.openFile(bestBlocks % phylTree.fileName[anc], "rb")
+    fo = utils.myFile.openFile(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], "wb")
+    shutil.copyfileobj(fi, fo)
     fo.close()
+    fi.close()
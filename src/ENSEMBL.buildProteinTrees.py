@@ -5,6 +5,12 @@
 
 __doc__ = """
     Edit Ensembl's gene trees by optimising the placement of duplication nodes according to a score function
+    The trees are written in the phylTree format, or in JSON (one tree per line) with +jsonOutput,
+    which is faster to load
+    With -nbThreads, the trees are edited in parallel, using the index of the forest
+    (see ALL.indexGeneTrees.py), with the same output. The index is read from the -index
+    file if it is up to date, and otherwise built and saved there (or only built in memory,
+    without -index)
 
     Usage:
         src/ENSEMBL.buildProteinTrees.py example/data/Species.nwk example/data/EnsemblGeneTreeForest.nhx.bz2 \
@@ -12,9 +18,12 @@ __doc__ = """
 """
 
 
+import os
 import sys
+import pickle
 import itertools
 import collections
+import tempfile
 
 import utils.myFile
 import utils.myTools
@@ -24,7 +33,7 @@ from utils.myTools import file
 
 arguments = utils.myTools.checkArgs( \
         [("speciesTree",file), ("ensemblTree",file)], \
-        [("cutoff",str,"-1"), ("defaultFamName",str,"GCUSGT%08d"), ("scoreMethod",int,[1,2,3]), ("newNodeID",int,100000000), ("recurs",bool,False)], \
+        [("cutoff",str,"-1"), ("defaultFamName",str,"GCUSGT%08d"), ("scoreMethod",int,[1,2,3]), ("newNodeID",int,100000000), ("recurs",bool,False), ("jsonOutput",bool,False), ("nbThreads",int,1), ("index",str,"")], \
         __doc__ \
 )
 
@@ -241,11 +250,10 @@ def testDuplicationInLaterNode(tree, rnode):
 
 
 
-nbEdit = {"dubious": 0, "toolow": 0, "good": 0}
-
-nbdup = 0
-
-for (nb,tree) in enumerate(utils.myProteinTree.loadTree(arguments["ensemblTree"])):
+# Edit the tree number nb, and return it with its numbers of editions and duplications
+def buildTree(nb, tree):
+        # hasLowScore reads and updates these
+        global passage, MauvaiseDup, node, inf
         treename = ''
         nbEditspe = {"dubious": 0, "toolow": 0, "good": 0}
        # print >> sys.stderr, 'SPECIES', phylTree.listSpecies
@@ -289,9 +297,7 @@ for (nb,tree) in enumerate(utils.myProteinTree.loadTree(arguments["ensemblTree"]
                                 #on s'arrete aux feuilles
                                # print >> sys.stderr,"EROOOOOOOOR4"
                                 if passage == 1:
-                                        nbEdit["good"] += 1
                                         nbEditspe["good"] += 1
-                                        nbdup +=1
                                         nbdupspe +=1
 
 
@@ -299,7 +305,6 @@ for (nb,tree) in enumerate(utils.myProteinTree.loadTree(arguments["ensemblTree"]
                                 if inf['Duplication'] != 0:
                                         if passage == 1:
                                                # print >> sys.stderr, 'ouii'
-                                                nbdup +=1
                                                 nbdupspe +=1
 
                                         if 'dubious_duplication' in inf:
@@ -307,7 +312,6 @@ for (nb,tree) in enumerate(utils.myProteinTree.loadTree(arguments["ensemblTree"]
                                                 assert inf['Duplication'] == 1
                                                 del inf['dubious_duplication']
                                                 if passage == 1:
-                                                        nbEdit["dubious"] += 1
                                                         nbEditspe["dubious"] += 1
                                                # print >> sys.stderr, "DUBIOUS", node,inf
                                                 boucle = 0
@@ -318,7 +322,6 @@ for (nb,tree) in enumerate(utils.myProteinTree.loadTree(arguments["ensemblTree"]
                                                 NodeModif.append(node)
                                                 inf['Duplication'] = 1
                                                 if passage == 1:
-                                                        nbEdit["toolow"] += 1
                                                         nbEditspe["toolow"] += 1
                                                 #print >> sys.stderr, "HasLowScore", node,inf
                                                 #testDuplicationInLaterNode
@@ -340,7 +343,6 @@ for (nb,tree) in enumerate(utils.myProteinTree.loadTree(arguments["ensemblTree"]
                                                         assert inf['Duplication'] in [2,3]
                                                        # print >> sys.stderr,"other", node, inf
                                                 if passage == 1:
-                                                        nbEdit["good"] += 1
                                                         nbEditspe["good"] += 1
 
                # for (node,inf) in tree.info.iteritems():
@@ -664,8 +666,73 @@ for (nb,tree) in enumerate(utils.myProteinTree.loadTree(arguments["ensemblTree"]
         if "tree_name" not in tree.info[tree.root]:
                 tree.info[tree.root]["tree_name"] = arguments["defaultFamName"] % nb
 
-        tree.printTree(sys.stdout)
+        return (tree, nbEditspe, nbdupspe)
+
+
+def printTree(tree):
+        if arguments["jsonOutput"]:
+                tree.printJSON(sys.stdout)
+        else:
+                tree.printTree(sys.stdout)
+
+
+# The new nodes of rebuildTree are numbered from newNodeID, across the trees.
+# Every tree of a shard is edited as if it were the first one, and the numbers
+# of its new nodes are shifted afterwards (see shiftNodeIDs)
+def buildShard(args):
+        (shard, outName) = args
+        nbEditShard = {"dubious": 0, "toolow": 0, "good": 0}
+        nbdupShard = 0
+        with open(outName, "wb") as out:
+                for (nb, tree) in zip(shard, utils.myProteinTree.loadTree(arguments["ensemblTree"], trees=shard, index=index)):
+                        utils.myProteinTree.nextNodeID = arguments["newNodeID"]
+                        (tree, nbEditspe, nbdupspe) = buildTree(nb, tree)
+                        pickle.dump((tree, utils.myProteinTree.nextNodeID - arguments["newNodeID"]), out)
+                        for x in nbEditShard:
+                                nbEditShard[x] += nbEditspe[x]
+                        nbdupShard += nbdupspe
+        return (nbEditShard, nbdupShard)
+
+
+# Renumber the nbNewNodes new nodes of a tree edited by buildShard so that they
+# come after the ones of the previous trees, as with a single process
+def shiftNodeIDs(tree, nbNewNodes, shift):
+        def newID(node):
+                return node + shift if arguments["newNodeID"] < node <= arguments["newNodeID"] + nbNewNodes else node
+        tree.data = {newID(node): [(newID(g), d) for (g, d) in lst] for (node, lst) in tree.data.items()}
+        tree.info = {newID(node): inf for (node, inf) in tree.info.items()}
+        tree.root = newID(tree.root)
+
+
+nbEdit = {"dubious": 0, "toolow": 0, "good": 0}
+
+nbdup = 0
 
+if (arguments["nbThreads"] > 1) and os.path.isfile(arguments["ensemblTree"]):
+        index = utils.myProteinTree.ForestIndex.load(arguments["ensemblTree"], arguments["index"])
+        # More shards than threads, for a better balance
+        shards = [list(shard) for shard in index.getShards(2 * arguments["nbThreads"])]
+        with tempfile.TemporaryDirectory() as tmpDir:
+                outNames = [os.path.join(tmpDir, "shard%d" % i) for i in range(len(shards))]
+                results = utils.myTools.dynamicPoolMap(buildShard, list(zip(shards, outNames)), arguments["nbThreads"])
+                # The shards are ranges of consecutive trees, in the order of the forest
+                for (shard, outName, (nbEditShard, nbdupShard)) in zip(shards, outNames, results):
+                        with open(outName, "rb") as f:
+                                for _ in shard:
+                                        (tree, nbNewNodes) = pickle.load(f)
+                                        shiftNodeIDs(tree, nbNewNodes, utils.myProteinTree.nextNodeID - arguments["newNodeID"])
+                                        utils.myProteinTree.nextNodeID += nbNewNodes
+                                        printTree(tree)
+                        for x in nbEdit:
+                                nbEdit[x] += nbEditShard[x]
+                        nbdup += nbdupShard
+else:
+        for (nb,tree) in enumerate(utils.myProteinTree.loadTree(arguments["ensemblTree"])):
+                (tree, nbEditspe, nbdupspe) = buildTree(nb, tree)
+                printTree(tree)
+                for x in nbEdit:
+                        nbEdit[x] += nbEditspe[x]
+                nbdup += nbdupspe
 
 print('total edition', nbEdit, file=sys.stderr)
 print('total duplication', nbdup, file=sys.stderr)
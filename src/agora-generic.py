@@ -48,5 +48,5 @@ workflow.publishGenome(outputName="generic-workflow")
 
 # Launching tasks in multiple threads
 #####################################
-failed = workflow.tasklist.runAll(arguments["nbThreads"], arguments["sequential"], arguments["forceRerun"])
+failed = workflow.run(arguments)
 sys.exit(failed)
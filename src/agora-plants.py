@@ -44,5 +44,5 @@ workflow.publishGenome(outputName="plants-workflow")
 
 # Launching tasks in multiple threads
 #####################################
-failed = workflow.tasklist.runAll(arguments["nbThreads"], arguments["sequential"], arguments["forceRerun"])
+failed = workflow.run(arguments)
 sys.exit(failed)
@@ -29,5 +29,5 @@ workflow.publishGenome(outputName="vertebrates-workflow")
 
 # Launching tasks in multiple threads
 #####################################
-failed = workflow.tasklist.runAll(arguments["nbThreads"], arguments["sequential"], arguments["forceRerun"])
+failed = workflow.run(arguments)
 sys.exit(failed)
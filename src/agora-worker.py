@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# AGORA v3.1
+# python 3.5
+# Copyright © 2006-2022 IBENS/Dyogen, 2020-2021 EMBL-European Bioinformatics Institute, 2021-2022 Genome Research Ltd : Matthieu MUFFATO, Alexandra LOUIS, Thi Thuy Nga NGUYEN, Hugues ROEST CROLLIUS
+# mail : agora@bio.ens.psl.eu
+# This is free software; you may copy, modify and/or distribute this work under the terms of the GNU General Public License, version 3 or later and the CeCiLL v2 license in France
+
+import os
+import sys
+import time
+
+import utils.myAgoraWorkflow
+import utils.myTools
+
+__doc__ = """
+    Run the tasks that an AGORA workflow launched with -backend=jobdir has
+    submitted to its job directory (by default the "jobs" directory in the
+    working directory). Start as many workers as needed, on any host that
+    sees the working directory at the same path. Each worker runs one task
+    at a time.
+
+    Usage:
+          src/agora-worker.py example/results/jobs
+          src/agora-worker.py example/results/jobs -idleTimeout=600
+"""
+
+arguments = utils.myTools.checkArgs(
+    [("jobDir", str)],
+    [("idleTimeout", int, 0)],
+    __doc__
+)
+
+# The scripts are found in the same directory as this one
+os.environ["PATH"] = os.path.dirname(os.path.abspath(__file__)) + os.pathsep + os.environ.get("PATH", "")
+
+jobDir = utils.myAgoraWorkflow.JobDirectory(arguments["jobDir"])
+lastJob = time.time()
+while True:
+    job = jobDir.claimJob()
+    if job is None:
+        if arguments["idleTimeout"] and (time.time() - lastJob > arguments["idleTimeout"]):
+            print("No job for %d seconds, exiting" % arguments["idleTimeout"], file=sys.stderr)
+            break
+        time.sleep(jobDir.pollInterval)
+        continue
+    print("Running job", job, file=sys.stderr)
+    if jobDir.runJob(job) is None:
+        print("Job", job, "given up (considered lost by the workflow)", file=sys.stderr)
+    else:
+        print("Job", job, "done", file=sys.stderr)
+    lastJob = time.time()
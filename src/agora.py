@@ -6,7 +6,6 @@
 # mail : agora@bio.ens.psl.eu
 # This is free software; you may copy, modify and/or distribute this work under the terms of the GNU General Public License, version 3 or later and the CeCiLL v2 license in France
 
-import multiprocessing
 import os
 import re
 import sys
@@ -27,7 +26,7 @@ __doc__ = """
 
 arguments = utils.myTools.checkArgs(
     [("agora.ini", file)],
-    [("workingDir", str, "."), ("nbThreads", int, multiprocessing.cpu_count()), ("forceRerun", bool, False), ("sequential", bool, True), ("printWorkflowGraph", str, ""),
+    [("workingDir", str, "."), ("nbThreads", int, None), ("forceRerun", bool, False), ("sequential", bool, None), ("perAncestor", bool, False), ("maxMemory", utils.myTools.MemorySizeArgChecker, 0), ("hashInputs", bool, False), ("backend", str, ["subprocess", "inprocess", "jobdir"]), ("jobDir", str, ""), ("trace", str, ""), ("estimate", bool, False), ("costModel", str, ""), ("monitorInterval", float, 5.), ("binaryOutput", bool, False), ("cacheGenomes", bool, False), ("compactGenomes", bool, False), ("printWorkflowGraph", str, ""),
      ],
     __doc__)
 
@@ -73,12 +72,14 @@ outputDir = arguments["workingDir"]
 for (f, s) in utils.myAgoraWorkflow.AgoraWorkflow.defaultPaths.items():
     files[f] = os.path.normpath(os.path.join(outputDir, conffiles.get(f.lower(), s)))
 scriptDir = os.path.dirname(os.path.abspath(__file__))
+if not arguments["jobDir"]:
+    arguments["jobDir"] = os.path.join(outputDir, "jobs")
 
 phylTree = utils.myPhylTree.PhylogeneticTree(files["speciesTree"])
 
 
 # TODO: add options in config file to change the target ancestors / species
-workflow = utils.myAgoraWorkflow.AgoraWorkflow(phylTree.root, None, scriptDir, files)
+workflow = utils.myAgoraWorkflow.AgoraWorkflow(phylTree.root, None, scriptDir, files, phylTree, arguments["perAncestor"], arguments["binaryOutput"], arguments["compactGenomes"])
 
 # Ancestral genes lists Section
 ################################
@@ -170,5 +171,5 @@ if arguments["printWorkflowGraph"]:
 
 # Launching tasks in multiple threads
 #####################################
-failed = workflow.tasklist.runAll(arguments["nbThreads"], arguments["sequential"], arguments["forceRerun"])
+failed = workflow.run(arguments)
 sys.exit(failed)
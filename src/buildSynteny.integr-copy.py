@@ -8,7 +8,9 @@
 
 __doc__ = """
     Simple script to copy ancestral blocks to another directory. Useful to combine
-    different reconstructions (on different ancestors) in one directory
+    different reconstructions (on different ancestors) in one directory.
+    With -format=text or -format=binary, the blocks are converted to that
+    format (see +binaryOutput) instead of being copied as they are
 
     Usage:
         src/buildSynteny.integr-copy.py example/data/Species.nwk A0 \
@@ -16,17 +18,19 @@ __doc__ = """
                 -OUT.ancBlocks=example/results/filtBlocks/best-pass1-all/blocks.%s.list.bz2
 """
 
+import shutil
 import time
 import sys
 
 import utils.myFile
+import utils.myGenomes
 import utils.myPhylTree
 import utils.myTools
 from utils.myTools import file
 
 # Arguments
 arguments = utils.myTools.checkArgs([("speciesTree", file), ("target", str)],
-                                    [("IN.ancBlocks", str, ""), ("OUT.ancBlocks", str, "")],
+                                    [("IN.ancBlocks", str, ""), ("OUT.ancBlocks", str, ""), ("format", str, ["", "text", "binary"])],
                                     __doc__
                                     )
 
@@ -35,10 +39,14 @@ phylTree = utils.myPhylTree.PhylogeneticTree(arguments["speciesTree"])
 targets = phylTree.getTargetsAnc(arguments["target"])
 
 for anc in targets:
-    fi = utils.myFile.openFile(arguments["IN.ancBlocks"] % phylTree.fileName[anc], "r")
-    fo = utils.myFile.openFile(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], "w")
-    for l in fi:
-        fo.write(l)
+    if arguments["format"]:
+        (name, blocks) = utils.myGenomes.loadAncBlocks(arguments["IN.ancBlocks"] % phylTree.fileName[anc])
+        utils.myGenomes.saveAncBlocks(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], name or anc, blocks, arguments["format"] == "binary")
+        continue
+    # Copied as bytes, whatever the format
+    fi = utils.myFile.openFile(arguments["IN.ancBlocks"] % phylTree.fileName[anc], "rb")
+    fo = utils.myFile.openFile(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], "wb")
+    shutil.copyfileobj(fi, fo)
     fo.close()
     fi.close()
 
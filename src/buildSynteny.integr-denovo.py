@@ -37,6 +37,7 @@ arguments = utils.myTools.checkArgs(
      ("OUT.ancBlocks", str, ""),
      ("ancGenesFiles", str, ""),
      ("nbThreads", int, 0),
+     ("binaryOutput", bool, False),
      ],
     __doc__
 )
@@ -46,7 +47,7 @@ def do(anc):
 
     diags = utils.myGraph.loadConservedPairsAnc(arguments["pairwise"] % phylTree.fileName[anc])
 
-    g = utils.myGenomes.Genome(arguments["ancGenesFiles"] % phylTree.fileName[anc], withDict=False).lstGenes
+    g = utils.myGenomes.Genome.load(arguments["ancGenesFiles"] % phylTree.fileName[anc], withDict=False).lstGenes
     singletons = set(range(len(g[None]))) if None in g else set(g)
 
     print("Blocks of %s ..." % anc, end=' ', file=sys.stderr)
@@ -64,7 +65,7 @@ def do(anc):
     # Cut the graph in subgraph
     graph.cleanGraphTopDown(arguments["minimalWeight"], searchLoops=arguments["searchLoops"])
 
-    f = utils.myFile.openFile(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], "w")
+    blocks = []
     s = []
 
     # Graph linearisation
@@ -78,13 +79,11 @@ def do(anc):
 
         s.append(len(da))
         singletons.difference_update(da)
-        res = [anc, len(da), utils.myFile.myTSV.printLine(da, " "), utils.myFile.myTSV.printLine(ds, " "),
-               utils.myFile.myTSV.printLine(dw, " ")]
-        print(utils.myFile.myTSV.printLine(res), file=f)
+        blocks.append((da, ds, dw))
 
     for x in singletons:
-        print(utils.myFile.myTSV.printLine([anc, 1, x, 1, ""]), file=f)
-    f.close()
+        blocks.append(([x], [1], []))
+    utils.myGenomes.saveAncBlocks(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], anc, blocks, arguments["binaryOutput"])
     print("OK", file=sys.stderr)
     print(anc,  utils.myMaths.myStats.syntheticTxtSummary(s), "+ %d singletons OK" % len(singletons), file=sys.stderr)
 
@@ -102,6 +101,6 @@ targets = phylTree.getTargetsAnc(arguments["target"])
 print("Targets:", sorted(targets), file=sys.stderr)
 
 n_cpu = arguments["nbThreads"] or multiprocessing.cpu_count()
-multiprocessing.Pool(n_cpu).map(do, sorted(targets))
+utils.myTools.dynamicPoolMap(do, sorted(targets), n_cpu)
 
 print("Elapsed time:", (time.time() - start), file=sys.stderr)
@@ -62,7 +62,7 @@ arguments = utils.myTools.checkArgs(
     [("IN.ancBlocks", str, ""), ("OUT.ancBlocks", str, ""), ("LOG.ancGraph", str, ""),
      ("nbThreads", int, 0),
      ("minimalWeight", int, 1), ("mustExtend", bool, False), ("loop", bool, False), ("timeout", int, 150),
-     ("func", str, "0,32|100,40t|10000")],
+     ("func", str, "0,32|100,40t|10000"), ("binaryOutput", bool, False)],
     __doc__
 )
 
@@ -676,15 +676,9 @@ def do(anc):
         integr = newintegr
 
     # Print the blocks
-    f = utils.myFile.openFile(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], "w")
-    for (i, (newb, news)) in enumerate(newintegr):
-        print(utils.myFile.myTSV.printLine(
-            [anc, len(newb), utils.myFile.myTSV.printLine([x[0] for x in newb], delim=" "),
-             utils.myFile.myTSV.printLine([x[1] for x in newb], delim=" "),
-             utils.myFile.myTSV.printLine(news, delim=" ")]), file=f)
-    for x in singletons:
-        print(utils.myFile.myTSV.printLine([anc, 1, x, 1, ""]), file=f)
-    f.close()
+    blocks = [([x[0] for x in newb], [x[1] for x in newb], news) for (newb, news) in newintegr]
+    blocks.extend(([x], [1], []) for x in singletons)
+    utils.myGenomes.saveAncBlocks(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], anc, blocks, arguments["binaryOutput"])
 
     # Revert to the true standard output
     sys.stdout.close()
@@ -715,6 +709,6 @@ def loadPairwise(file):
 print("Targets:", sorted(targets), file=sys.stderr)
 
 n_cpu = arguments["nbThreads"] or multiprocessing.cpu_count()
-multiprocessing.Pool(n_cpu).map(do, sorted(targets))
+utils.myTools.dynamicPoolMap(do, sorted(targets), n_cpu)
 
 print("total computation time", (time.time() - start), file=sys.stderr)
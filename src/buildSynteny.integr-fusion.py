@@ -36,7 +36,7 @@ arguments = utils.myTools.checkArgs(
     [("speciesTree", file), ("target", str), ("pairwise", str)],
     [("minimalWeight", int, 1), ("searchLoops", bool, True), ("onlySingletons", bool, False),
      ("nbThreads", int, 0),
-     ("IN.ancBlocks", str, ""), ("OUT.ancBlocks", str, ""), ("LOG.ancGraph", str, "")],
+     ("IN.ancBlocks", str, ""), ("OUT.ancBlocks", str, ""), ("LOG.ancGraph", str, ""), ("binaryOutput", bool, False)],
     __doc__
 )
 
@@ -62,16 +62,13 @@ def do(anc):
     # cutting the graph
     graph.cleanGraphTopDown(arguments["minimalWeight"], searchLoops=arguments["searchLoops"])
 
-    f = utils.myFile.openFile(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], "w")
+    blocks = []
     s = []
 
     if arguments["onlySingletons"]:
         # If this option is set, the blocks are printed as they are
         for (b, w) in integr:
-            print(utils.myFile.myTSV.printLine([anc, len(b),
-                                                      utils.myFile.myTSV.printLine([x[0] for x in b], " "),
-                                                      utils.myFile.myTSV.printLine([x[1] for x in b], " "),
-                                                      utils.myFile.myTSV.printLine(w, " ")]), file=f)
+            blocks.append(([x[0] for x in b], [x[1] for x in b], w))
 
     # Compute the blocks
     for (d, dw) in graph.getBestDiags():
@@ -84,13 +81,11 @@ def do(anc):
 
         s.append(len(da))
         singletons.difference_update(da)
-        print(utils.myFile.myTSV.printLine(
-            [anc, len(da), utils.myFile.myTSV.printLine(da, " "), utils.myFile.myTSV.printLine(ds, " "),
-             utils.myFile.myTSV.printLine(dw, " ")]), file=f)
+        blocks.append((da, ds, dw))
 
     for x in singletons:
-        print(utils.myFile.myTSV.printLine([anc, 1, x, 1, ""]), file=f)
-    f.close()
+        blocks.append(([x], [1], []))
+    utils.myGenomes.saveAncBlocks(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], anc, blocks, arguments["binaryOutput"])
     print(utils.myMaths.myStats.txtSummary(s), "+ %d singletons OK" % len(singletons), file=sys.stderr)
 
     # Revert to the true standard output
@@ -106,6 +101,6 @@ phylTree = utils.myPhylTree.PhylogeneticTree(arguments["speciesTree"])
 targets = phylTree.getTargetsAnc(arguments["target"])
 
 n_cpu = arguments["nbThreads"] or multiprocessing.cpu_count()
-multiprocessing.Pool(n_cpu).map(do, sorted(targets))
+utils.myTools.dynamicPoolMap(do, sorted(targets), n_cpu)
 
 print("Elapsed time:", (time.time() - start), file=sys.stderr)
@@ -37,7 +37,7 @@ arguments = utils.myTools.checkArgs(
     [("speciesTree", file), ("target", str), ("pairwise", str)],
     [("IN.ancBlocks", str, ""), ("OUT.ancBlocks", str, ""), ("REF.ancBlocks", str, ""), ("LOG.ancGraph", str, ""),
      ("nbThreads", int, 0),
-     ("selectionFunction", str, "newscore/float(oldscore) if oldscore else newscore")],
+     ("selectionFunction", str, "newscore/float(oldscore) if oldscore else newscore"), ("binaryOutput", bool, False)],
     __doc__
 )
 
@@ -146,7 +146,7 @@ def do(anc):
         toaddblocks[k] = ([], [])
 
     print("Output blocks of ", anc, end=' ', file=sys.stderr)
-    f = utils.myFile.openFile(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], "w")
+    blocks = []
     ll = []
     # Build and print new chromosomes
     for (i, (inib, iniw)) in enumerate(iniblocks):
@@ -192,10 +192,7 @@ def do(anc):
         assert len(newb) >= 2
         assert len(newb) == (len(neww) + 1)
         ll.append(len(newb))
-        print(utils.myFile.myTSV.printLine([anc, len(newb),
-                                                  utils.myFile.myTSV.printLine([x[0] for x in newb], delim=" "),
-                                                  utils.myFile.myTSV.printLine([x[1] for x in newb], delim=" "),
-                                                  utils.myFile.myTSV.printLine(neww, delim=" ")]), file=f)
+        blocks.append(([x[0] for x in newb], [x[1] for x in newb], neww))
 
     sing = 0
     for (newb, news) in toaddblocks:
@@ -205,11 +202,8 @@ def do(anc):
             ll.append(len(newb))
         else:
             sing += len(newb)
-        print(utils.myFile.myTSV.printLine([anc, len(newb),
-                                                  utils.myFile.myTSV.printLine([x[0] for x in newb], delim=" "),
-                                                  utils.myFile.myTSV.printLine([x[1] for x in newb], delim=" "),
-                                                  utils.myFile.myTSV.printLine(news, delim=" ")]), file=f)
-    f.close()
+        blocks.append(([x[0] for x in newb], [x[1] for x in newb], news))
+    utils.myGenomes.saveAncBlocks(arguments["OUT.ancBlocks"] % phylTree.fileName[anc], anc, blocks, arguments["binaryOutput"])
     print(utils.myMaths.myStats.txtSummary(ll), "+", sing, "singletons", file=sys.stderr)
 
     # Revert to the true standard output
@@ -233,6 +227,6 @@ def loadPairwise(anc):
 
 
 n_cpu = arguments["nbThreads"] or multiprocessing.cpu_count()
-multiprocessing.Pool(n_cpu).map(do, sorted(targets))
+utils.myTools.dynamicPoolMap(do, sorted(targets), n_cpu)
 
 print("Elapsed time:", (time.time() - start), file=sys.stderr)
@@ -43,7 +43,8 @@ arguments = utils.myTools.checkArgs( \
      ("LOG.ancGraph", str, ""),
      ("OUT.ancBlocks", str, ""), \
      ("genesFiles", str, ""), \
-     ("ancGenesFiles", str, "")], \
+     ("ancGenesFiles", str, ""), \
+     ("compactGenomes", bool, False)], \
     __doc__ \
     )
 
@@ -198,47 +199,23 @@ phylTree = utils.myPhylTree.PhylogeneticTree(arguments["speciesTree"])
 listSpecies = sorted(listSpecies)
 
 # Gene names don't matter by themselves. What is important is that they link the dicGenomes
-# and the genesAnc. utils.myGenomes uses sys.intern() to make them refer to the same string
-# instances to reduce the memory usage. Here we go further and we replace the names with
-# unique integers (the smallest object in Python) to save even more memory
-name_hash = {}
-n_names = 0
-def myintern(s):
-    t = name_hash.get(s)
-    if t:
-        return t
-    global n_names
-    n_names += 1
-    name_hash[s] = n_names
-    return n_names
-
-utils.myGenomes.intern = myintern
+# and the genesAnc. Here we replace the names with unique integers (the smallest object in
+# Python) to save memory
+names = utils.myGenomes.GeneNameRegistry()
+
+# Compact genomes use less memory, but are slower to go through
+genomeClass = utils.myGenomes.CompactGenome if arguments["compactGenomes"] else utils.myGenomes.Genome
 
 genesAnc = {}
 for anc in sorted(targets.union(accessoryAncestors)):
-    genesAnc[anc] = utils.myGenomes.Genome(arguments["ancGenesFiles"] % phylTree.fileName[anc])
-
-# Here's another trick. Once we have loaded all the ancestral genes, we have indexed the
-# names of all extant genes. Since extant genes are unique, we can clear the names used by
-# each species right after having loaded it
-# Note: this set will also contain the chromosome names
-species_names = set()
-def myintern_species(s):
-    species_names.add(s)
-    return myintern(s)
-
-utils.myGenomes.intern = myintern_species
+    genesAnc[anc] = genomeClass.load(arguments["ancGenesFiles"] % phylTree.fileName[anc], names=names)
 
 dicGenomes = {}
 for e in listSpecies:
-    dicGenomes[e] = utils.myGenomes.Genome(arguments["genesFiles"] % phylTree.fileName[e], withDict=False)
-    for s in species_names:
-        del name_hash[s]
-    species_names = set()
+    dicGenomes[e] = genomeClass.load(arguments["genesFiles"] % phylTree.fileName[e], withDict=False, names=names)
 
-# Now that the names have been replaced, let's empty the cache and restore intern
-name_hash = {}
-utils.myGenomes.intern = sys.intern
+# Now that the names have been replaced, the registry is not needed any more
+del names
 
 toStudy = collections.defaultdict(list)
 for (e1, e2) in itertools.combinations(listSpecies, 2):
@@ -247,5 +224,5 @@ for (e1, e2) in itertools.combinations(listSpecies, 2):
 
 start = time.time()
 n_cpu = arguments["nbThreads"] or multiprocessing.cpu_count()
-multiprocessing.Pool(n_cpu).map(do, sorted(targets))
+utils.myTools.dynamicPoolMap(do, sorted(targets), n_cpu)
 print("Elapsed time:", (time.time() - start), file=sys.stderr)
@@ -39,7 +39,7 @@ arguments = utils.myTools.checkArgs(
 	 ("genesFiles",str,""), ("ancGenesFiles",str,""), ("iniAncGenesFiles",str,""), ("OUT.pairwise",str,""),
 	 ("anchorSize",int,2),
 	 ("nbThreads", int, 0),
-	 ("LOG.pairwise", str, "")],
+	 ("LOG.pairwise", str, ""), ("binaryOutput", bool, False), ("compactGenomes", bool, False)],
 	__doc__
 )
 
@@ -127,25 +127,22 @@ def getAllAdj(anc):
 		ind.update(dict.fromkeys(set(phylTree.species[x]).intersection(listSpecies), i+1))
 
 	res = arguments["OUT.pairwise"] % phylTree.fileName[anc]
-	f = utils.myFile.openFile(res, "w")
-	for ancPair in allAdj:
-
-		# Compute the weight (number of comparisons that support this adjacency)
-		weights = collections.defaultdict(int)
-		for esp in allAdj[ancPair]:
-			weights[ind[esp]] += 1
-		weight = sum(x*y for (x,y) in itertools.combinations(list(weights.values()), 2))
-
-		if weight == 0:
-			# None of the adjacencies is conserved through this ancestor
-			continue
-
-		# to debug the weight: "|".join("%s/%d" % (esp,ind[esp]) for esp in sorted(allAdj[ancPair]))
-		print(utils.myFile.myTSV.printLine(
-			list(ancPair[0] + ancPair[1]) +
-			[weight]
-		), file=f)
-	f.close()
+	def iterPairs():
+		for ancPair in allAdj:
+
+			# Compute the weight (number of comparisons that support this adjacency)
+			weights = collections.defaultdict(int)
+			for esp in allAdj[ancPair]:
+				weights[ind[esp]] += 1
+			weight = sum(x*y for (x,y) in itertools.combinations(list(weights.values()), 2))
+
+			if weight == 0:
+				# None of the adjacencies is conserved through this ancestor
+				continue
+
+			# to debug the weight: "|".join("%s/%d" % (esp,ind[esp]) for esp in sorted(allAdj[ancPair]))
+			yield ancPair[0] + ancPair[1] + (weight,)
+	utils.myGraph.saveConservedPairsAnc(res, iterPairs(), arguments["binaryOutput"])
 
 
 
@@ -153,15 +150,26 @@ phylTree = utils.myPhylTree.PhylogeneticTree(arguments["speciesTree"])
 
 (listSpecies, targets, accessoryAncestors) = phylTree.getTargetsForPairwise(arguments["target"], arguments["extantSpeciesFilter"])
 
+# Compact genomes use less memory, but are slower to go through. The gene names
+# are then replaced with integers, as they are only used to link the genomes:
+# unlike strings, the worker processes can read them without copying them
+if arguments["compactGenomes"]:
+	genomeClass = utils.myGenomes.CompactGenome
+	genomeArgs = {"names": utils.myGenomes.GeneNameRegistry()}
+else:
+	genomeClass = utils.myGenomes.Genome
+	genomeArgs = {}
+
 dicGenomes = {}
 for e in sorted(listSpecies):
-	dicGenomes[e] = utils.myGenomes.Genome(arguments["genesFiles"] % phylTree.fileName[e])
+	dicGenomes[e] = genomeClass.load(arguments["genesFiles"] % phylTree.fileName[e], **genomeArgs)
 
 genesAnc = {}
 for anc in sorted(targets.union(accessoryAncestors)):
-	genesAnc[anc] = utils.myGenomes.Genome(arguments["iniAncGenesFiles"] % phylTree.fileName[anc])
+	genesAnc[anc] = genomeClass.load(arguments["iniAncGenesFiles"] % phylTree.fileName[anc], **genomeArgs)
 for anc in sorted(targets):
-	dicGenomes[anc] = utils.myGenomes.Genome(arguments["ancGenesFiles"] % phylTree.fileName[anc], ancGenes=genesAnc[anc], withDict=False)
+	dicGenomes[anc] = genomeClass(arguments["ancGenesFiles"] % phylTree.fileName[anc], ancGenes=genesAnc[anc], withDict=False, **genomeArgs)
+del genomeArgs
 
 toStudy = collections.defaultdict(list)
 for (e1,e2) in itertools.combinations(listSpecies, 2):
@@ -170,6 +178,6 @@ for (e1,e2) in itertools.combinations(listSpecies, 2):
 
 start = time.time()
 n_cpu = arguments["nbThreads"] or multiprocessing.cpu_count()
-multiprocessing.Pool(n_cpu).map(getAllAdj, sorted(targets))
+utils.myTools.dynamicPoolMap(getAllAdj, sorted(targets), n_cpu)
 print("Elapsed time:", (time.time() - start), file=sys.stderr)
 
@@ -24,6 +24,7 @@ import time
 import utils.myMaths
 import utils.myPhylTree
 import utils.myGenomes
+import utils.myGraph
 import utils.myTools
 from utils.myTools import file
 
@@ -31,7 +32,7 @@ from utils.myTools import file
 # Arguments
 arguments = utils.myTools.checkArgs(
         [("speciesTree",file), ("target",str)], \
-        [("extantSpeciesFilter",str,""), ("genesFiles",str,""), ("ancGenesFiles",str,""), ("OUT.pairwise",str,"")],
+        [("extantSpeciesFilter",str,""), ("genesFiles",str,""), ("ancGenesFiles",str,""), ("OUT.pairwise",str,""), ("binaryOutput",bool,False)],
         __doc__
 )
 
@@ -53,15 +54,12 @@ def revPair(pair):
 dicAncMod = collections.defaultdict(lambda: collections.defaultdict(lambda: collections.defaultdict(list)))
 dicModAnc = collections.defaultdict(list)
 
-# We override intern() in order to be able to clear its cache once all the loading is done
-name_hash = {}
-def myintern(s):
-        return name_hash.setdefault(s, s)
-utils.myGenomes.intern = myintern
+# The gene names are replaced with integers, and the registry is dropped once all the loading is done
+names = utils.myGenomes.GeneNameRegistry()
 
 genesAnc = {}
 for anc in sorted(listAncestors.union(accessoryAncestors)):
-        ancGenes = utils.myGenomes.Genome(arguments["ancGenesFiles"] % phylTree.fileName[anc])
+        ancGenes = utils.myGenomes.Genome.load(arguments["ancGenesFiles"] % phylTree.fileName[anc], names=names)
         genesAnc[anc] = {k: v.index for (k,v) in ancGenes.dicGenes.items()}
         del ancGenes
 
@@ -81,7 +79,7 @@ for esp in listSpecies:
 del genesAnc
 
 def extractPairsFromSpecies(esp):
-        genome = utils.myGenomes.Genome(arguments["genesFiles"] % phylTree.fileName[esp], withDict=False)
+        genome = utils.myGenomes.Genome.load(arguments["genesFiles"] % phylTree.fileName[esp], withDict=False, names=names)
 
         print("Extraction of gene pairs from %s " % esp, "...", end=' ', file=sys.stderr)
 
@@ -122,9 +120,8 @@ def extractPairsFromSpecies(esp):
 for esp in sorted(listSpecies):
         extractPairsFromSpecies(esp)
 
-# Now that all the genomes have been loaded, let's empty the cache and restore intern
-name_hash = {}
-utils.myGenomes.intern = sys.intern
+# Now that all the genomes have been loaded, the names are not needed any more
+del names
 
 print("time for task1", time.time() - start, file=sys.stderr)
 start = time.time()
@@ -209,23 +206,20 @@ def reportPairs(anc):
                 ind.update(dict.fromkeys(set(phylTree.species[x]).intersection(listSpecies), i+1))
 
         res = arguments["OUT.pairwise"] % phylTree.fileName[anc]
-        f = utils.myFile.openFile(res, "w")
-        for ancPair in pairs:
-
-                #assert ancPair[0][0] < ancPair[1][0]
-                #assert set(pairs[ancPair]).isdisjoint([(x[0],revPair(x[1])) for x in pairs[ancPair]])
-
-                # Compute the weight (number of comparisons that support this adjacency)
-                weights = collections.defaultdict(int)
-                for modPair in pairs[ancPair]:
-                        weights[ind[modPair[0]]] += 1
-                weight = sum(x*y for (x,y) in itertools.combinations(list(weights.values()), 2))
-
-                print(utils.myFile.myTSV.printLine(
-                        list(ancPair[0] + ancPair[1]) +
-                        [weight]
-                ), file=f)
-        f.close()
+        def iterPairs():
+                for ancPair in pairs:
+
+                        #assert ancPair[0][0] < ancPair[1][0]
+                        #assert set(pairs[ancPair]).isdisjoint([(x[0],revPair(x[1])) for x in pairs[ancPair]])
+
+                        # Compute the weight (number of comparisons that support this adjacency)
+                        weights = collections.defaultdict(int)
+                        for modPair in pairs[ancPair]:
+                                weights[ind[modPair[0]]] += 1
+                        weight = sum(x*y for (x,y) in itertools.combinations(list(weights.values()), 2))
+
+                        yield ancPair[0] + ancPair[1] + (weight,)
+        utils.myGraph.saveConservedPairsAnc(res, iterPairs(), arguments["binaryOutput"])
 
 for anc in sorted(listAncestors):
         reportPairs(anc)
@@ -30,7 +30,7 @@ from utils.myTools import file
 # Arguments
 arguments = utils.myTools.checkArgs(
     [("speciesTree", file), ("target", str)],
-    [("nbThreads", int, 0), ("IN.blocksBlocksFile", str, ""), ("IN.blocksGenesFile", str, ""), ("OUT.ancBlocksFile", str, "")],
+    [("nbThreads", int, 0), ("IN.blocksBlocksFile", str, ""), ("IN.blocksGenesFile", str, ""), ("OUT.ancBlocksFile", str, ""), ("binaryOutput", bool, False)],
     __doc__
 )
 
@@ -42,47 +42,43 @@ def do(anc):
     (diags,singletons) = utils.myGraph.loadIntegr(arguments["IN.blocksBlocksFile"] % phylTree.fileName[anc])
 
     print("Loading reference blocks set from", arguments["IN.blocksGenesFile"] % phylTree.fileName[anc], "...", end=' ', file=sys.stderr)
-    ref = {}
-    fi = utils.myFile.openFile(arguments["IN.blocksGenesFile"] % phylTree.fileName[anc], "r")
-    for (i,l) in enumerate(fi):
-        ref[i+1] = l
-    fi.close()
+    (name, refBlocks) = utils.myGenomes.loadAncBlocks(arguments["IN.blocksGenesFile"] % phylTree.fileName[anc])
+    ref = {i+1: b for (i,b) in enumerate(refBlocks)}
     print("OK", file=sys.stderr)
 
     print("Writing ancBlocks of", anc, "...", end=' ', file=sys.stderr)
     lengths = []
-    fo = utils.myFile.openFile(arguments["OUT.ancBlocksFile"] % phylTree.fileName[anc], "w")
+    blocks = []
     for (chrom,weights) in diags:
         li = []
         ls = []
         lw = []
-        n = 0
         for (i,(c,s)) in enumerate(chrom):
-            t = ref.pop(c)[:-1].split("\t")
+            (genes, strands, blockWeights) = ref.pop(c)
             if i >= 1:
                 lw.append(weights[i-1])
-            n += len(t[2].split())
             if s > 0:
-                li.append(t[2])
-                ls.append(t[3])
-                lw.append(t[4])
+                li.extend(genes)
+                ls.extend(strands)
+                lw.extend(blockWeights)
             else:
-                li.extend(reversed(t[2].split()))
-                ls.extend(-int(x) for x in reversed(t[3].split()))
-                lw.extend(reversed(t[4].split()))
+                li.extend(reversed(genes))
+                ls.extend(-x for x in reversed(strands))
+                lw.extend(reversed(blockWeights))
 
-        lengths.append(n)
-        print(utils.myFile.myTSV.printLine([t[0], n, utils.myFile.myTSV.printLine(li, delim=" "), utils.myFile.myTSV.printLine(ls, delim=" "), utils.myFile.myTSV.printLine(lw, delim=" ")]), file=fo)
+        lengths.append(len(li))
+        blocks.append((li, ls, lw))
 
     ns = 0
     for c in singletons:
-        l = ref.pop(c)
-        n = len(l[:-1].split("\t")[2].split())
+        b = ref.pop(c)
+        n = len(b[0])
         if n >= 2:
             lengths.append(n)
         else:
             ns += 1
-        fo.write(l)
+        blocks.append(b)
+    utils.myGenomes.saveAncBlocks(arguments["OUT.ancBlocksFile"] % phylTree.fileName[anc], name or anc, blocks, arguments["binaryOutput"])
 
     # Ensure all the blocks have been used
     assert len(ref) == 0
@@ -90,5 +86,5 @@ def do(anc):
 
 start = time.time()
 n_cpu = arguments["nbThreads"] or multiprocessing.cpu_count()
-multiprocessing.Pool(n_cpu).map(do, sorted(targets))
+utils.myTools.dynamicPoolMap(do, sorted(targets), n_cpu)
 print("Time elapsed:", time.time() - start, file=sys.stderr)
@@ -62,7 +62,7 @@ def do(anc):
             names[s] = i
 
     # Print the ancestral genome, using the actual gene names provided by ancGenesFiles
-    ancGenes = utils.myGenomes.Genome(arguments["ancGenesFiles"] % phylTree.fileName[anc]).lstGenes[None]
+    ancGenes = utils.myGenomes.Genome.load(arguments["ancGenesFiles"] % phylTree.fileName[anc]).lstGenes[None]
     ancGenomeFile = utils.myFile.openFile(arguments["OUT.ancGenomes"] % phylTree.fileName[anc], "w")
     for s in block_names:
         for gene in genome.lstGenes[s]:
@@ -71,5 +71,5 @@ def do(anc):
 
 start = time.time()
 n_cpu = arguments["nbThreads"] or multiprocessing.cpu_count()
-multiprocessing.Pool(n_cpu).map(do, sorted(targets))
+utils.myTools.dynamicPoolMap(do, sorted(targets), n_cpu)
 print("Time elapsed:", time.time() - start, file=sys.stderr)
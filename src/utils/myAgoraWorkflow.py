@@ -7,25 +7,392 @@
 # This is free software; you may copy, modify and/or distribute this work under the terms of the GNU General Public License, version 3 or later and the CeCiLL v2 license in France
 
 import collections
+import glob
+import hashlib
+import heapq
 import itertools
 import json
 import multiprocessing
 import os
 import resource
+import runpy
+import shutil
+import socket
 import subprocess
 import sys
 import time
 import threading
+import traceback
 
 import psutil
 
 from . import myFile
+from . import myGenomes
 from . import myPhylTree
 from . import myTools
 
 # A command that will be run. args represents the entire command-line, incl. the executable
 Command = collections.namedtuple("Command", ['args', 'out', 'log'])
-Task = collections.namedtuple("Task", ['dependencies', 'command', 'multithreaded'])
+# outputs lists the output files (or %s patterns) given on the command-line
+# as plain arguments or as the value of an option other than -OUT.xxx
+Task = collections.namedtuple("Task", ['dependencies', 'command', 'multithreaded', 'outputs'])
+
+# Chunk size when compressing the output of a command in Python
+copyBufferSize = 16 * 1024 * 1024
+
+# Run a command, with its standard output and error going to its out and log files
+# env contains the environment variables to add. name is used in the messages
+# Returns the exit code, or None if the command could not be started
+def runCommand(command, env, name):
+    # The command writes directly to its output file, unless it has to be compressed.
+    # Compression then happens in a separate program (bzip2, gzip, xz) reading
+    # from a pipe, or, if not installed, here in large chunks
+    outName = command.out or os.devnull
+    compressor = myFile.getNativeCompressor(outName)
+    if compressor:
+        # The compressor writes to the file itself
+        os.makedirs(os.path.dirname(outName) or ".", exist_ok=True)
+        rawout = open(outName, "wb")
+        stdout = subprocess.Popen(compressor, stdin=subprocess.PIPE, stdout=rawout)
+        rawout.close()
+        target = stdout.stdin
+    elif myFile.isCompressed(outName):
+        stdout = myFile.openFile(outName, "wb")
+        target = subprocess.PIPE
+    else:
+        stdout = myFile.openFile(outName, "wb")
+        target = stdout
+    # stderr must have a fileno, so must be a regular file (not a .bz2 etc)
+    stderr = myFile.openFile(command.log, "wb") if command.log else subprocess.DEVNULL
+    try:
+        p = subprocess.Popen(command.args, stdout=target, stderr=stderr, env=dict(os.environ, **env))
+    except Exception as e:
+        if compressor:
+            stdout.stdin.close()
+            stdout.wait()
+        else:
+            stdout.close()
+        if command.log:
+            stderr.close()
+        print(name, "could not start:", e)
+        return None
+
+    if compressor:
+        # Only the compressor must hold the pipe, to see the end of the stream
+        stdout.stdin.close()
+        r = p.wait()
+        rc = stdout.wait()
+        if r == 0 and rc != 0:
+            print("%s: %s exited with code %d" % (name, compressor[0], rc))
+            r = rc
+    elif target is subprocess.PIPE:
+        shutil.copyfileobj(p.stdout, stdout, copyBufferSize)
+        r = p.wait()
+        stdout.close()
+    else:
+        r = p.wait()
+        stdout.close()
+    if command.log:
+        stderr.close()
+    return r
+
+
+# A persistent process that runs the scripts in-process, one after the other.
+# The modules are only imported once, and the species trees and ancestral genes
+# loaded by a task are kept in cache for the next tasks
+##################################################################################
+class InProcessWorker:
+
+    # Maximum number of genomes kept in cache
+    maxCachedGenomes = 256
+
+    def __init__(self):
+        (self.conn, workerConn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=self.loop, args=(workerConn,))
+        self.process.start()
+        self.pid = self.process.pid
+
+    # Returns the exit code, the CPU time and the peak memory usage of the script
+    # (0 here, as the memory monitor follows the worker process itself)
+    # env contains the environment variables to set for the script
+    def run(self, command, env={}):
+        self.conn.send((command, env))
+        try:
+            return self.conn.recv() + (0,)
+        except EOFError:
+            # The worker died
+            return (-1, 0, 0)
+
+    def stop(self):
+        if self.process.is_alive():
+            self.conn.send(None)
+        self.process.join()
+
+    # Worker to use for the next tasks
+    def restart(self):
+        if self.process.is_alive():
+            return self
+        self.process.join()
+        return InProcessWorker()
+
+    # What follows runs in the worker process
+
+    def loop(self, conn):
+        self.installCaches()
+        while True:
+            job = conn.recv()
+            if job is None:
+                break
+            conn.send(self.runScript(*job))
+
+    @staticmethod
+    def getCacheKey(path):
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_size, st.st_mtime)
+
+    # The cached objects are shared between the tasks, which must not modify them.
+    # The classes are replaced with subclasses whose constructor returns instances
+    # of the original classes, as the latter refer to themselves by name
+    def installCaches(self):
+        phylTrees = {}
+        genomes = collections.OrderedDict()
+        phylTreeClass = myPhylTree.PhylogeneticTree
+        genomeClass = myGenomes.Genome
+        getCacheKey = self.getCacheKey
+        maxCachedGenomes = self.maxCachedGenomes
+
+        class CachedPhylogeneticTree(phylTreeClass):
+            def __new__(cls, file=None, *args, **kwargs):
+                if not isinstance(file, str) or args or kwargs:
+                    return phylTreeClass(file, *args, **kwargs)
+                key = getCacheKey(file)
+                if key not in phylTrees:
+                    phylTrees[key] = phylTreeClass(file)
+                return phylTrees[key]
+
+        class CachedGenome(genomeClass):
+            def __new__(cls, fichier, **kwargs):
+                # Genomes built from another genome, or with a GeneNameRegistry, cannot be shared
+                if not isinstance(fichier, str) or ("ancGenes" in kwargs) or (kwargs.get("names") is not None):
+                    return genomeClass(fichier, **kwargs)
+                key = (getCacheKey(fichier), tuple(sorted(kwargs.items())))
+                if key in genomes:
+                    genomes.move_to_end(key)
+                else:
+                    genomes[key] = genomeClass(fichier, **kwargs)
+                    if len(genomes) > maxCachedGenomes:
+                        genomes.popitem(last=False)
+                return genomes[key]
+
+        myPhylTree.PhylogeneticTree = CachedPhylogeneticTree
+        myGenomes.Genome = CachedGenome
+
+    def runScript(self, command, env):
+        script = myTools.which(command.args[0]) or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), command.args[0])
+        ru_self = resource.getrusage(resource.RUSAGE_SELF)
+        ru_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+        # The scripts may change the global state of the modules
+        modules = dict((name, dict(vars(module))) for (name, module) in list(sys.modules.items()) if name.startswith(__package__ + "."))
+        (argv, stdout, stderr, recursionLimit) = (sys.argv, sys.stdout, sys.stderr, sys.getrecursionlimit())
+        environ = dict(os.environ)
+        os.environ.update(env)
+        sys.argv = [script] + command.args[1:]
+        if command.log:
+            # Line-buffered like the standard error of the scripts
+            os.makedirs(os.path.dirname(command.log) or ".", exist_ok=True)
+            sys.stderr = open(command.log, "w", buffering=1)
+        sys.stdout = myFile.openFile(command.out or os.devnull, "w")
+        try:
+            runpy.run_path(script, run_name="__main__")
+            r = 0
+        except SystemExit as e:
+            if isinstance(e.code, int) or (e.code is None):
+                r = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                r = 1
+        except Exception:
+            traceback.print_exc()
+            r = 1
+        finally:
+            sys.stdout.close()
+            if command.log:
+                sys.stderr.close()
+            (sys.argv, sys.stdout, sys.stderr) = (argv, stdout, stderr)
+            sys.setrecursionlimit(recursionLimit)
+            os.environ.clear()
+            os.environ.update(environ)
+            for (name, saved) in modules.items():
+                module = sys.modules[name]
+                module.__dict__.clear()
+                module.__dict__.update(saved)
+
+        ru_self_end = resource.getrusage(resource.RUSAGE_SELF)
+        ru_children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = sum(end.ru_utime + end.ru_stime - begin.ru_utime - begin.ru_stime for (begin, end) in [(ru_self, ru_self_end), (ru_children, ru_children_end)])
+        return (r, cpu)
+
+
+# Shared-filesystem job directory. The workflow submits the commands as job
+# files, which agora-worker.py processes, possibly on other hosts, claim and run:
+#   pending/JOB.json -> running/JOB.json -> done/JOB.json
+# A running job that looks stale is moved to lost/JOB.json by the workflow, and
+# its worker then gives it up
+# The working directory must be at the same path on all the hosts
+##################################################################################
+class JobDirectory:
+
+    # How often (in seconds) the job files are checked
+    pollInterval = 2
+    # A running job whose file has not been touched for so long is considered lost
+    staleTimeout = 300
+
+    def __init__(self, path):
+        self.path = path
+        for state in ["pending", "running", "done", "lost"]:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def getJobPath(self, state, job):
+        return os.path.join(self.path, state, job + ".json")
+
+    # The readers must never see a partial file
+    @staticmethod
+    def writeJson(path, data):
+        with open(path + ".tmp", "w") as fh:
+            json.dump(data, fh)
+        os.replace(path + ".tmp", path)
+
+    # Both the workflow and the workers may remove the files of a lost job
+    @staticmethod
+    def removeFile(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    # What follows is used by the workflow
+
+    # Same interface as InProcessWorker
+    pid = None
+
+    def run(self, command, env={}):
+        # Job names sort in submission order
+        job = "%017.6f-%s-%d" % (time.time(), socket.gethostname(), os.getpid())
+        self.writeJson(self.getJobPath("pending", job), {"args": command.args, "out": command.out, "log": command.log, "cwd": os.getcwd(), "env": env})
+        print("Submitted job", job)
+        done = self.getJobPath("done", job)
+        running = self.getJobPath("running", job)
+        while True:
+            time.sleep(self.pollInterval)
+            self.removeLostResults()
+            # The worker writes the result before removing the running file
+            if os.path.exists(done):
+                return self.readResult(job)
+            try:
+                age = time.time() - os.path.getmtime(running)
+            except FileNotFoundError:
+                continue
+            if age > self.staleTimeout:
+                # Moved rather than removed, so that the worker sees that the
+                # job has been given up, even if it is still alive
+                try:
+                    os.rename(running, self.getJobPath("lost", job))
+                except FileNotFoundError:
+                    # The job has just finished
+                    continue
+                # It may have finished just before
+                if os.path.exists(done):
+                    self.removeFile(self.getJobPath("lost", job))
+                    return self.readResult(job)
+                print("Job", job, "has been lost")
+                return (-1, 0, 0)
+
+    def readResult(self, job):
+        done = self.getJobPath("done", job)
+        with open(done, "r") as fh:
+            result = json.load(fh)
+        os.remove(done)
+        print("Job", job, "ran on", result["host"])
+        return (result["status"], result["cpu_time"], result["peak_memory"])
+
+    # The results of the lost jobs that have come late
+    def removeLostResults(self):
+        for name in os.listdir(os.path.join(self.path, "lost")):
+            if name.endswith(".json"):
+                self.removeFile(os.path.join(self.path, "done", name))
+
+    def stop(self):
+        pass
+
+    def restart(self):
+        return self
+
+    # What follows is used by agora-worker.py
+
+    # Oldest pending job, which is then marked as running. None if there is none
+    def claimJob(self):
+        for name in sorted(os.listdir(os.path.join(self.path, "pending"))):
+            if not name.endswith(".json"):
+                continue
+            job = name[:-5]
+            try:
+                # Atomic: only one worker can succeed
+                os.rename(self.getJobPath("pending", job), self.getJobPath("running", job))
+                # The file keeps the time it was submitted
+                os.utime(self.getJobPath("running", job))
+                return job
+            except FileNotFoundError:
+                pass
+        return None
+
+    # The job runs in a new process, to get its own resource usage
+    # Returns None if the workflow has given up the job (see run)
+    def runJob(self, job):
+        running = self.getJobPath("running", job)
+        done = self.getJobPath("done", job)
+        try:
+            with open(running, "r") as fh:
+                spec = json.load(fh)
+        except FileNotFoundError:
+            return None
+        proc = multiprocessing.Process(target=self.executeJob, args=(job, spec))
+        proc.start()
+        lost = False
+        while proc.is_alive() and not lost:
+            proc.join(self.pollInterval)
+            # Heartbeat, to show that the job is not lost
+            try:
+                os.utime(running)
+            except FileNotFoundError:
+                lost = True
+        if lost:
+            proc.terminate()
+            proc.join()
+        elif (proc.exitcode != 0) and not os.path.exists(done):
+            # Killed before writing its result (which the workflow may already
+            # have read otherwise)
+            self.writeJson(done, {"status": -1, "cpu_time": 0, "peak_memory": 0, "host": socket.gethostname()})
+        try:
+            os.remove(running)
+        except FileNotFoundError:
+            lost = True
+        if lost:
+            # Nobody is waiting for the result anymore
+            self.removeFile(done)
+            return None
+        return proc.exitcode
+
+    def executeJob(self, job, spec):
+        os.chdir(spec["cwd"])
+        r = runCommand(Command(spec["args"], spec["out"], spec["log"]), spec["env"], "job " + job)
+        ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.writeJson(self.getJobPath("done", job), {
+            "status": -1 if r is None else r,
+            "cpu_time": ru.ru_utime + ru.ru_stime,
+            "peak_memory": ru.ru_maxrss * TaskList.rusage_unit,
+            "host": socket.gethostname(),
+            })
 
 
 # Managing the list of programs to launch and their dependencies
@@ -34,6 +401,12 @@ class TaskList():
 
     rusage_unit = 1 if sys.platform == "darwin" else 1024
     status_filename = '.agora'
+    threads_filename = '.threads'
+    # Ratio between the peak memory usage of a task that has never run and
+    # the size of its input files (mostly compressed text files)
+    memoryEstimateFactor = 10
+    # Expected duration (in seconds) of a task that has never run
+    defaultTaskDuration = 60
 
     def __init__(self):
         self.list = []
@@ -41,13 +414,23 @@ class TaskList():
         self.nrun = 0
         self.proc = {}
         self.nthreads = {}
+        self.expectedMemory = {}
+        self.previousStatus = {}
+        self.deferred = []
+        self.relaunched = set()
+        self.hashInputs = False
+        # Environment variables given to every task
+        self.env = {}
+        self.trace = None
         self.completed = 0
         self.failed = 0
-        manager = multiprocessing.Manager()
-        self.self_pids = [os.getpid(), manager._process.pid]
-        self.queue = manager.Queue()
-        self.memusage = manager.dict()
-        self.memlock = manager.Lock()
+        # Completion messages from the wrapper processes, through a pipe
+        self.queue = multiprocessing.SimpleQueue()
+        # Processes followed by memoryMonitor: pid -> task
+        self.monitored = {}
+        self.monitorLock = threading.Lock()
+        self.monitorStop = threading.Event()
+        self.workflowPeakMemory = 0
 
     def printGraphviz(self, fh):
         print("digraph", "{", file=fh)
@@ -57,12 +440,12 @@ class TaskList():
                 print('%d -> %d' % (dep, taskId), file=fh)
         print("}", file=fh)
 
-    def addTask(self, name, dep, command, multithreaded=False):
+    def addTask(self, name, dep, command, multithreaded=False, outputs=[]):
         taskId = len(self.list)
         print("New task", taskId, name)
         print(dep)
         print(command)
-        self.list.append(Task(set(self.dic[x] for x in dep), command, multithreaded))
+        self.list.append(Task(set(self.dic[x] for x in dep), command, multithreaded, outputs))
         if name in self.dic:
             if name + ("1",) in self.dic:
                 self.list[self.dic[name]].dependencies.add(taskId)
@@ -76,7 +459,7 @@ class TaskList():
                 print("! Name clash ! Introducing a collector task")
                 collectorId = self.dic[name]
                 self.list.append(self.list[collectorId])
-                self.list[collectorId] = Task(set([taskId, taskId + 1]), Command(None, None, None), False)
+                self.list[collectorId] = Task(set([taskId, taskId + 1]), Command(None, None, None), False, [])
                 self.dic[name + ("1",)] = taskId + 1
                 self.dic[name + ("2",)] = taskId
         else:
@@ -84,19 +467,100 @@ class TaskList():
         print()
         return taskId
 
+    # Build the reverse edges of the dependency graph, and the number of
+    # unsatisfied dependencies of each task. Tasks with no dependencies
+    # are pushed onto the heap of ready tasks
+    # getDuration gives the expected duration of a task (getExpectedDuration by default)
+    def initScheduler(self, getDuration=None):
+        self.dependents = [[] for _ in self.list]
+        self.indegree = [len(task.dependencies) for task in self.list]
+        for (i, task) in enumerate(self.list):
+            for dep in task.dependencies:
+                self.dependents[dep].append(i)
+        # Kept for the resource usage of the previous run
+        for i in range(len(self.list)):
+            self.previousStatus[i] = self.readStatusFile(i)
+        self.initPriorities(getDuration or self.getExpectedDuration)
+        self.ready = []
+        for (i, task) in enumerate(self.list):
+            if not task.dependencies:
+                self.ready.append(self.priorities[i])
+        heapq.heapify(self.ready)
+
+    # Expected duration of a task: the one of its previous run, or a static estimate
+    def getExpectedDuration(self, i):
+        if not self.list[i].command.args:
+            return 0
+        previous = self.previousStatus.get(i)
+        if previous and "stats" in previous:
+            return previous["stats"]["elapsed"]
+        return self.defaultTaskDuration
+
+    # The priority of a task is the expected duration of the longest path
+    # from the task to the end of the workflow (critical path).
+    # Ties are broken in favour of multithreaded tasks, so that they get
+    # the cores before the single-threaded ones, and then by task id
+    def initPriorities(self, getDuration):
+        remaining = [len(deps) for deps in self.dependents]
+        toVisit = [i for (i, n) in enumerate(remaining) if n == 0]
+        pathLength = [0] * len(self.list)
+        # Reverse topological order: the dependents of a task are visited before the task
+        while toVisit:
+            i = toVisit.pop()
+            pathLength[i] = getDuration(i) + max((pathLength[j] for j in self.dependents[i]), default=0)
+            for dep in self.list[i].dependencies:
+                remaining[dep] -= 1
+                if remaining[dep] == 0:
+                    toVisit.append(dep)
+        self.priorities = [(-pathLength[i], not task.multithreaded, i) for (i, task) in enumerate(self.list)]
+        if pathLength:
+            print("Expected duration of the critical path: %g sec" % max(pathLength))
+
+    # A readable name for each task
+    def getTaskNames(self):
+        names = {}
+        for (name, taskId) in sorted(self.dic.items()):
+            names.setdefault(taskId, "/".join(name))
+        return names
+
+    # Run the scheduler on a simulated clock, with the same policy as runAll(),
+    # sequential meaning one task at a time
+    # costs gives for each task its CPU time, its memory usage per thread, and
+    # how many threads it can use at most
+    # Returns the start time, end time and number of threads of each task
+    def simulate(self, nbThreads, sequential, costs):
+        def getDuration(i):
+            (cpu, _, parallelism) = costs[i]
+            return cpu / (min(nbThreads, parallelism) if self.list[i].multithreaded else 1)
+        self.initScheduler(getDuration)
+        schedule = {}
+        running = []
+        clock = 0
+        while self.ready or running:
+            while self.ready and (self.nrun < nbThreads) and not (sequential and self.nrun):
+                i = heapq.heappop(self.ready)[-1]
+                (cpu, _, parallelism) = costs[i]
+                nthreads = nbThreads - self.nrun if self.list[i].multithreaded else 1
+                end = clock + cpu / min(nthreads, parallelism)
+                schedule[i] = (clock, end, nthreads)
+                heapq.heappush(running, (end, i))
+                self.nrun += nthreads
+            (clock, i) = heapq.heappop(running)
+            self.nrun -= schedule[i][2]
+            self.removeDep(i)
+        return schedule
+
     def removeDep(self, i):
-        for t in self.list:
-            t.dependencies.discard(i)
+        for j in self.dependents[i]:
+            self.indegree[j] -= 1
+            if self.indegree[j] == 0:
+                heapq.heappush(self.ready, self.priorities[j])
 
     def getAvailable(self):
-        tmp = [i for (i, task) in enumerate(self.list) if len(task.dependencies) == 0]
-        print("Available tasks:", tmp)
-        if len(tmp) > 0:
-            taskId = tmp[0]
-            # Add something (None) to the dependency list so that the task is never selected again
-            # This way the task numbers remain the same
-            self.list[taskId].dependencies.add(None)
-            return taskId
+        print("Available tasks:", [key[-1] for key in sorted(self.ready)])
+        if self.ready:
+            # The task is popped, so it can never be selected again
+            return heapq.heappop(self.ready)[-1]
         else:
             return None
 
@@ -104,9 +568,11 @@ class TaskList():
     def joinNext(self):
         print("Waiting ...")
         sys.stdout.flush()
-        (i, r) = self.queue.get()
+        (i, r, stats) = self.queue.get()
         print("task", i, "is now finished (status %d)" % r)
+        self.traceEnd(i, r, stats)
         self.proc.pop(i).join()
+        self.unmonitorTask(i)
         if r == 0:
             self.removeDep(i)
             self.completed += 1
@@ -114,6 +580,156 @@ class TaskList():
             self.failed += 1
             print(">", "Inspect", self.list[i].command.log, "for more information", file=sys.stderr)
         self.nrun -= self.nthreads.pop(i)
+        self.removeThreadsFile(i)
+        self.traceThreads()
+        self.expectedMemory.pop(i)
+        if i in self.workers:
+            self.idleWorkers.append(self.workers.pop(i).restart())
+        # Some memory has been freed: the deferred tasks may fit now
+        for j in self.deferred:
+            heapq.heappush(self.ready, self.priorities[j])
+        self.deferred = []
+
+    # Execution trace, in the Chrome trace-event format (chrome://tracing, ui.perfetto.dev)
+    # Each thread is shown as a lane, to make the idle threads visible
+    def initTrace(self, start, nbThreads):
+        self.trace = [{"name": "process_name", "ph": "M", "pid": 0, "args": {"name": "AGORA workflow"}}]
+        self.trace.extend({"name": "thread_name", "ph": "M", "pid": 0, "tid": lane, "args": {"name": "thread %d" % lane}} for lane in range(nbThreads))
+        self.traceStart = start
+        self.traceNbThreads = nbThreads
+        self.freeLanes = list(range(nbThreads))
+        self.lanes = {}
+        self.launchTimes = {}
+        self.segmentStarts = {}
+        self.taskNames = self.getTaskNames()
+
+    def addTraceEvent(self, phase, name, t, **kwargs):
+        if self.trace is not None:
+            event = {"name": name, "ph": phase, "ts": int((t - self.traceStart) * 1e6), "pid": 0}
+            event.update(kwargs)
+            self.trace.append(event)
+
+    def getTraceName(self, i):
+        return "%d %s" % (i, self.taskNames.get(i, ""))
+
+    # Task that is not run (status is the reason why)
+    def traceInstant(self, i, status):
+        if self.trace is not None:
+            self.addTraceEvent("i", self.getTraceName(i), time.time(), s="p", args={"status": status})
+
+    def traceLaunch(self, i, nthreads):
+        if self.trace is not None:
+            self.launchTimes[i] = self.segmentStarts[i] = time.time()
+            self.lanes[i] = [heapq.heappop(self.freeLanes) for _ in range(nthreads)]
+            self.traceThreads()
+
+    # The task is shown on as many lanes as it has threads, from start to end
+    def traceSegment(self, i, start, end, args):
+        for lane in self.lanes[i]:
+            self.addTraceEvent("X", self.getTraceName(i), start, dur=int((end - start) * 1e6), tid=lane, args=args)
+
+    def traceEnd(self, i, r, stats):
+        if self.trace is not None:
+            start = self.launchTimes.pop(i)
+            segmentStart = self.segmentStarts.pop(i)
+            end = max(start + stats["elapsed"] if stats else time.time(), segmentStart)
+            args = {"status": "completed" if r == 0 else "failed (%d)" % r, "threads": self.nthreads[i], "command": " ".join(self.list[i].command.args)}
+            if stats:
+                args["cpu_time"] = stats["cpu_time"]
+                args["peak_memory_MB"] = stats["peak_memory"] / 1024. / 1024.
+            self.traceSegment(i, segmentStart, end, args)
+            for lane in self.lanes.pop(i):
+                heapq.heappush(self.freeLanes, lane)
+            # Close the memory series of the task
+            self.addTraceEvent("C", "memory per task (MB)", end, args={self.getTraceName(i): 0})
+
+    # Called before the number of threads of the task changes
+    def traceResize(self, i, nthreads):
+        if self.trace is not None:
+            t = time.time()
+            self.traceSegment(i, self.segmentStarts[i], t, {"status": "running", "threads": self.nthreads[i]})
+            self.segmentStarts[i] = t
+            while len(self.lanes[i]) < nthreads:
+                self.lanes[i].append(heapq.heappop(self.freeLanes))
+            while len(self.lanes[i]) > nthreads:
+                heapq.heappush(self.freeLanes, self.lanes[i].pop())
+
+    def traceThreads(self):
+        if self.trace is not None:
+            self.addTraceEvent("C", "threads", time.time(), args={"busy": self.nrun, "idle": self.traceNbThreads - self.nrun})
+
+    # samples is a dictionary task -> memory usage, total the memory usage of the whole workflow
+    def traceMemory(self, samples, total):
+        t = time.time()
+        perTask = dict((self.getTraceName(i), mem / 1024. / 1024.) for (i, mem) in samples.items())
+        self.addTraceEvent("C", "memory per task (MB)", t, args=perTask)
+        self.addTraceEvent("C", "total memory (MB)", t, args={"total": total / 1024. / 1024.})
+
+    def writeTrace(self, fileName):
+        print("Writing the execution trace to", fileName)
+        with myFile.openFile(fileName, "w") as fh:
+            json.dump({"traceEvents": self.trace, "displayTimeUnit": "ms"}, fh)
+
+    # Cooperative protocol to change the number of threads of a multithreaded
+    # task while it runs: the task reads its current number of threads from a
+    # file (see myTools.dynamicPoolMap), which the scheduler updates
+    def getThreadsFilePath(self, i):
+        command = self.list[i].command
+        if self.list[i].multithreaded and (command.log or command.out):
+            return (command.log or command.out) + self.threads_filename
+        return None
+
+    def writeThreadsFile(self, i):
+        path = self.getThreadsFilePath(i)
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # Atomic update, the task must never see a partial file
+            with open(path + ".tmp", "w") as fh:
+                print(self.nthreads[i], file=fh)
+            os.replace(path + ".tmp", path)
+
+    def removeThreadsFile(self, i):
+        path = self.getThreadsFilePath(i)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def resizeTask(self, i, nthreads):
+        print("Task", i, "now has", nthreads, "threads instead of", self.nthreads[i])
+        self.traceResize(i, nthreads)
+        self.expectedMemory[i] = self.expectedMemory[i] * nthreads // self.nthreads[i]
+        self.nrun += nthreads - self.nthreads[i]
+        self.nthreads[i] = nthreads
+        self.writeThreadsFile(i)
+        self.traceThreads()
+
+    # Running multithreaded tasks that can change their number of threads,
+    # most critical first
+    def getResizableTasks(self):
+        return sorted((j for j in self.proc if self.getThreadsFilePath(j)), key=lambda j: self.priorities[j])
+
+    # Give the idle threads to the running multithreaded tasks
+    def growRunningTasks(self, nbThreads, maxMemory):
+        for j in self.getResizableTasks():
+            extra = nbThreads - self.nrun
+            if extra <= 0:
+                break
+            if maxMemory and self.expectedMemory[j]:
+                memPerThread = self.expectedMemory[j] / self.nthreads[j]
+                extra = min(extra, int((maxMemory - self.getMemoryInUse()) // memPerThread))
+            if extra > 0:
+                self.resizeTask(j, self.nthreads[j] + extra)
+
+    # Take a thread from a running multithreaded task if the next ready task
+    # is more critical. Returns whether a thread was freed
+    def shrinkRunningTasks(self):
+        if not self.ready:
+            return False
+        candidates = [j for j in self.getResizableTasks() if (self.nthreads[j] > 1) and (self.priorities[j] > self.ready[0])]
+        if not candidates:
+            return False
+        j = max(candidates, key=lambda j: self.nthreads[j])
+        self.resizeTask(j, self.nthreads[j] - 1)
+        return True
 
     def getJsonPath(self, i):
         command = self.list[i].command
@@ -129,6 +745,99 @@ class TaskList():
                 'log': command.log,
                 }
 
+    def readStatusFile(self, i):
+        status_file = self.getJsonPath(i)
+        if status_file and os.path.exists(status_file):
+            with open(status_file, 'r') as fh:
+                return json.load(fh)
+        return None
+
+    # The input files of a task are all the paths found on its command-line,
+    # except the outputs (-OUT.xxx and the outputs of the task) and the logs (-LOG.xxx)
+    def getInputPaths(self, i):
+        paths = []
+        for arg in self.list[i].command.args[1:]:
+            if arg.startswith(("-", "+")):
+                (opt, _, arg) = arg[1:].partition("=")
+                if opt.startswith("OUT.") or opt.startswith("LOG.") or not arg:
+                    continue
+            if arg in self.list[i].outputs:
+                continue
+            if "%s" in arg:
+                paths.extend(sorted(glob.glob(arg.replace("%s", "*"))))
+            elif os.path.isfile(arg):
+                paths.append(arg)
+        return paths
+
+    @staticmethod
+    def getFileHash(path):
+        h = hashlib.md5()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    # Size and modification time of every input file, plus its content hash if requested
+    def getInputFingerprints(self, i):
+        fingerprints = {}
+        for path in self.getInputPaths(i):
+            st = os.stat(path)
+            fingerprints[path] = {"size": st.st_size, "mtime": st.st_mtime}
+            if self.hashInputs:
+                fingerprints[path]["md5"] = self.getFileHash(path)
+        return fingerprints
+
+    # List the input files that have been added, removed or modified since
+    # they were recorded in the control file. Files that have only been
+    # touched are not reported if their content hash was recorded
+    def getChangedInputs(self, i, previous):
+        # Control files written by older versions of AGORA
+        if "inputs" not in previous:
+            return []
+        recorded = previous["inputs"]
+        current = set(self.getInputPaths(i))
+        changed = sorted(current.symmetric_difference(recorded))
+        for path in sorted(current.intersection(recorded)):
+            st = os.stat(path)
+            fingerprint = recorded[path]
+            if (st.st_size, st.st_mtime) == (fingerprint["size"], fingerprint["mtime"]):
+                continue
+            if ("md5" in fingerprint) and (st.st_size == fingerprint["size"]) and (self.getFileHash(path) == fingerprint["md5"]):
+                continue
+            changed.append(path)
+        return changed
+
+    # Expected peak memory usage of a task, for each of its threads if it is
+    # multithreaded. It comes from the control file of the previous run if
+    # any, otherwise it is guessed from the size of the input files
+    def getExpectedMemoryPerThread(self, i):
+        previous = self.previousStatus.get(i)
+        if previous and ("stats" in previous):
+            stats = previous["stats"]
+            return stats["peak_memory"] / (stats["threads"] if self.list[i].multithreaded else 1)
+        return self.memoryEstimateFactor * sum(os.path.getsize(path) for path in self.getInputPaths(i))
+
+    # Memory that the running tasks are expected to use at their peak
+    def getMemoryInUse(self):
+        return sum(max(self.expectedMemory[i], self.peakMemory[i]) for i in self.proc)
+
+    # Follow the memory usage of these processes (and their children) as part of task i
+    def monitorProcesses(self, i, pids):
+        with self.monitorLock:
+            for pid in pids:
+                self.monitored[pid] = i
+
+    def unmonitorTask(self, i):
+        with self.monitorLock:
+            for pid in [pid for (pid, j) in self.monitored.items() if j == i]:
+                del self.monitored[pid]
+
+    # On Linux, the memory usage is read directly from /proc, which is much
+    # cheaper than psutil.memory_full_info() (that parses the full smaps)
+    hasProcFS = os.path.exists("/proc/self/stat")
+    hasSmapsRollup = os.path.exists("/proc/self/smaps_rollup")
+    pageSize = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
     def getProcMemoryUsage(self, proc):
         try:
             # Slower and not available on macOS, but more accurate
@@ -136,102 +845,164 @@ class TaskList():
         except psutil.AccessDenied:
             return proc.memory_info().rss
 
+    # Unique set size (private pages) of the process, or None if it doesn't exist anymore
     def getMemoryUsage(self, pid):
+        if self.hasProcFS:
+            try:
+                if self.hasSmapsRollup:
+                    with open("/proc/%d/smaps_rollup" % pid, "rb") as fh:
+                        return 1024 * sum(int(l.split()[1]) for l in fh if l.startswith(b"Private_"))
+                # Older kernels: resident minus shared pages
+                with open("/proc/%d/statm" % pid, "rb") as fh:
+                    fields = fh.read().split()
+                return (int(fields[1]) - int(fields[2])) * self.pageSize
+            except (OSError, ValueError, IndexError):
+                return None
         try:
             proc = psutil.Process(pid)
             return self.getProcMemoryUsage(proc)
         except (psutil.NoSuchProcess, IOError):
             return None
 
-    def getRecursiveMemoryUsage(self, pid):
-        try:
-            proc = psutil.Process(pid)
-            total_mem = self.getProcMemoryUsage(proc)
-            children = proc.children(recursive=True)
-        except (psutil.NoSuchProcess, IOError):
-            return None
-        for subproc in children:
-            try:
-                mem = self.getProcMemoryUsage(subproc)
-                total_mem += mem
-            except (psutil.NoSuchProcess, IOError):
-                pass
-        return total_mem
-
-    def updateMemoryUsage(self, pid, mem):
-        # Can't do this atomically, so need to wrap it with a lock
-        self.memlock.acquire()
-        if (pid in self.memusage) and (mem > self.memusage[pid]):
-            self.memusage[pid] = mem
-        self.memlock.release()
-
+    # Dictionary pid -> list of children pids, of all the processes
+    def getChildrenMap(self):
+        children = collections.defaultdict(list)
+        if self.hasProcFS:
+            for name in os.listdir("/proc"):
+                if not name.isdigit():
+                    continue
+                try:
+                    with open("/proc/%s/stat" % name, "rb") as fh:
+                        # The process name may contain spaces and brackets
+                        ppid = int(fh.read().rsplit(b")", 1)[1].split()[1])
+                except (OSError, ValueError, IndexError):
+                    continue
+                children[ppid].append(int(name))
+        else:
+            for proc in psutil.process_iter(["pid", "ppid"]):
+                children[proc.info["ppid"]].append(proc.info["pid"])
+        return children
+
+    # Memory usage of each process of the workflow, incl. its children
+    def getRecursiveMemoryUsages(self, rootPid):
+        children = self.getChildrenMap()
+        order = [rootPid]
+        for pid in order:
+            order.extend(children.get(pid, []))
+        total = {}
+        # Children are after their parent in order
+        for pid in reversed(order):
+            mem = self.getMemoryUsage(pid)
+            if mem is not None:
+                total[pid] = mem + sum(total.get(child, 0) for child in children.get(pid, []))
+        return total
+
+    # The memory of every monitored process is sampled every monitorInterval seconds.
+    # The peak memory usage of each task is shared with the wrapper processes
     def memoryMonitor(self):
-        while self.memusage:
-            total_mem = 0
-            for pid in list(self.memusage.keys()):
-                mem = self.getRecursiveMemoryUsage(pid)
-                if mem:
-                    total_mem += mem
-                    self.updateMemoryUsage(pid, mem)
-            for pid in self.self_pids:
-                mem = self.getMemoryUsage(pid)
-                if mem:
-                    total_mem += mem
-            self.updateMemoryUsage(self.self_pids[0], mem)
-            time.sleep(5)
-
-    def printCPUUsageStats(self, intro, start):
+        mainPid = os.getpid()
+        while True:
+            total = self.getRecursiveMemoryUsages(mainPid)
+            with self.monitorLock:
+                monitored = list(self.monitored.items())
+            samples = collections.defaultdict(int)
+            for (pid, i) in monitored:
+                samples[i] += total.get(pid, 0)
+            for (i, mem) in samples.items():
+                if mem > self.peakMemory[i]:
+                    self.peakMemory[i] = mem
+            self.workflowPeakMemory = max(self.workflowPeakMemory, total.get(mainPid, 0))
+            if self.trace is not None:
+                # The main process includes all its children
+                self.traceMemory(samples, total.get(mainPid, 0))
+            if self.monitorStop.wait(self.monitorInterval):
+                break
+
+    # i is the task, None for the whole workflow
+    def printCPUUsageStats(self, intro, start, i=None, workerCPU=0, workerMemory=0):
         ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = ru.ru_utime + ru.ru_stime + workerCPU
         elapsed = time.time() - start
-        # Use the lock so that we don't remove the key in the middle of memoryMonitor using it
-        self.memlock.acquire()
-        mem = max(ru.ru_maxrss * self.rusage_unit, self.memusage.pop(os.getpid()))
-        self.memlock.release()
-        print(intro, "%g sec CPU time / %g sec elapsed = %g%% CPU usage, %g MB RAM" % (ru.ru_utime + ru.ru_stime, elapsed, 100. * (ru.ru_utime + ru.ru_stime) / elapsed, mem / 1024. / 1024.))
+        mem = max(ru.ru_maxrss * self.rusage_unit, self.workflowPeakMemory if i is None else self.peakMemory[i], workerMemory)
+        print(intro, "%g sec CPU time / %g sec elapsed = %g%% CPU usage, %g MB RAM" % (cpu, elapsed, 100. * cpu / elapsed, mem / 1024. / 1024.))
+        return {"cpu_time": cpu, "elapsed": elapsed, "peak_memory": mem}
 
     # Launch program function
-    def goLaunch(self, i, command, status_file):
+    # Runs in a wrapper process: a result must be queued whatever happens,
+    # otherwise the workflow waits for it forever
+    def goLaunch(self, i, command, status_file, nthreads, worker=None):
+        try:
+            self.launchTask(i, command, status_file, nthreads, worker)
+        except BaseException:
+            traceback.print_exc()
+            self.queue.put((i, -1, None))
+
+    def launchTask(self, i, command, status_file, nthreads, worker):
         start = time.time()
         if status_file and os.path.exists(status_file):
             os.remove(status_file)
-        stdout = myFile.openFile(command.out or os.devnull, "wb")
-        stderr = myFile.openFile(command.log, "wb") if command.log else subprocess.DEVNULL
-        # stderr must have a fileno, so must be a regular file (not a .bz2 etc)
-        # stdout can be anything, incl. a .bz2
-        try:
-            p = subprocess.Popen(command.args, stdout=subprocess.PIPE, stderr=stderr)
-        except Exception as e:
-            stdout.close()
-            stderr.close()
-            print("task %d could not start:" % i, e)
+        # Taken before the task starts, so that any later change is detected
+        inputs = self.getInputFingerprints(i) if status_file else None
+        threadsFile = self.getThreadsFilePath(i)
+        env = dict(self.env)
+        if threadsFile:
+            env[myTools.threadsFileVariable] = threadsFile
+        if worker:
+            (r, workerCPU, workerMemory) = worker.run(command, env)
+            stats = self.printCPUUsageStats("task %d report:" % i, start, i, workerCPU, workerMemory)
+            self.recordStatus(i, r, status_file, stats, nthreads, inputs)
+            return
+        r = runCommand(command, env, "task %d" % i)
+        if r is None:
             time.sleep(5)
-            self.queue.put((i, -1))
-            # FIXME: then it hangs in multiprocessing/managers (checking self.memusage)
+            self.queue.put((i, -1, None))
             return
+        stats = self.printCPUUsageStats("task %d report:" % i, start, i)
+        self.recordStatus(i, r, status_file, stats, nthreads, inputs)
 
-        # This is where the .bz2 compression would happen
-        for l in p.stdout:
-            stdout.write(l)
-        stderr.flush()
-        r = p.wait()
-        for l in p.stdout:
-            stdout.write(l)
-        stdout.close()
-        if command.log:
-            stderr.flush()
-            stderr.close()
+    def recordStatus(self, i, r, status_file, stats, nthreads, inputs):
         if r == 0 and status_file:
             report = self.getJsonPayload(i)
+            # Resource usage, to plan the next runs
+            stats["threads"] = nthreads
+            report["stats"] = stats
+            report["inputs"] = inputs
             with open(status_file, 'w') as fh:
                 json.dump(report, fh)
-        self.printCPUUsageStats("task %d report:" % i, start)
-        self.queue.put((i, r))
+        self.queue.put((i, r, stats))
 
     # Launching tasks in multiple threads
-    def runAll(self, nbThreads, sequential, forceRerun):
+    # sequential tells whether to run the tasks one at a time (each of them using up to nbThreads threads)
+    # maxMemory (in bytes) is the memory budget the running tasks have to fit in (0 means no limit)
+    # hashInputs tells whether to record the content hash of the input files, on top of their size and modification time
+    # backend is either "subprocess" (a new process for every task), "inprocess" (persistent InProcessWorker)
+    # or "jobdir" (agora-worker.py processes polling the JobDirectory jobDir)
+    # trace is the path of the execution trace to write (none if empty)
+    # monitorInterval is the time (in seconds) between two measures of the memory usage
+    def runAll(self, nbThreads, sequential, forceRerun, maxMemory=0, hashInputs=False, backend="subprocess", trace=None, jobDir=None, monitorInterval=5):
         start = time.time()
 
-        self.memusage[os.getpid()] = 0
+        print("Running the tasks", "sequentially" if sequential else "in parallel")
+        if maxMemory:
+            print("Memory budget: %g MB" % (maxMemory / 1024. / 1024.))
+        self.initScheduler()
+        self.hashInputs = hashInputs
+        if trace:
+            self.initTrace(start, nbThreads)
+
+        # Each task needs at least one thread, so there can't be more than nbThreads tasks running
+        if backend == "inprocess":
+            self.idleWorkers = [InProcessWorker() for _ in range(nbThreads)]
+        elif backend == "jobdir":
+            print("Submitting the tasks to", jobDir)
+            self.idleWorkers = [JobDirectory(jobDir) for _ in range(nbThreads)]
+        else:
+            self.idleWorkers = []
+        self.workers = {}
+
+        # Peak memory usage of each task, in shared memory for the wrapper processes
+        self.peakMemory = multiprocessing.RawArray('q', len(self.list))
+        self.monitorInterval = monitorInterval
         monitorThread = threading.Thread(target=self.memoryMonitor)
         monitorThread.start()
 
@@ -242,13 +1013,17 @@ class TaskList():
                     (len(self.list)-len(self.proc)-self.completed-self.failed, len(self.proc), self.completed, self.failed, len(self.list)))
 
             if (self.nrun == nbThreads) or (sequential and self.nrun):
-                self.joinNext()
+                if sequential or not self.shrinkRunningTasks():
+                    self.joinNext()
             else:
                 taskId = self.getAvailable()
                 if taskId is None:
+                    # Deferred tasks imply that some tasks are running
                     if self.nrun == 0:
                         print("Workflow stopped because of failures")
                         break
+                    if not sequential:
+                        self.growRunningTasks(nbThreads, maxMemory)
                     self.joinNext()
                 else:
                     command = self.list[taskId].command
@@ -262,41 +1037,80 @@ class TaskList():
                         print("'forceRerun' option given, not checking the control file")
                     elif status_file:
                         print("Control file", status_file, end=' ')
-                        if os.path.exists(status_file):
-                            with open(status_file, 'r') as fh:
-                                j = json.load(fh)
-                            if j == self.getJsonPayload(taskId):
-                                launch = False
-                                print("present - same parameters")
-                            else:
+                        j = self.previousStatus[taskId]
+                        if j is not None:
+                            if not all(j.get(key) == value for (key, value) in self.getJsonPayload(taskId).items()):
                                 print("present - different parameters")
+                            elif self.list[taskId].dependencies & self.relaunched:
+                                print("present - some dependencies have been rerun")
+                            else:
+                                changed = self.getChangedInputs(taskId, j)
+                                if changed:
+                                    print("present - modified input files:", " ".join(changed))
+                                else:
+                                    launch = False
+                                    print("present - same parameters and input files")
                         else:
                             print("missing")
                     else:
                         print("No control file could be identified")
                     if launch:
+                        nthreads = nbThreads - self.nrun if self.list[taskId].multithreaded else 1
+                        if maxMemory:
+                            memPerThread = self.getExpectedMemoryPerThread(taskId)
+                            available = maxMemory - self.getMemoryInUse()
+                            if memPerThread * nthreads > available:
+                                if self.nrun == 0:
+                                    # Nothing else to wait for
+                                    print("Task", taskId, "is expected to need %g MB, more than the budget" % (memPerThread * nthreads / 1024. / 1024.))
+                                    if memPerThread:
+                                        nthreads = min(nthreads, max(1, int(maxMemory // memPerThread)))
+                                elif memPerThread > available:
+                                    print("Deferring task", taskId, "(expected to need %g MB, %g MB available)" % (memPerThread / 1024. / 1024., available / 1024. / 1024.))
+                                    self.deferred.append(taskId)
+                                    self.traceInstant(taskId, "deferred")
+                                    continue
+                                else:
+                                    # Only multithreaded tasks can get here
+                                    nthreads = int(available // memPerThread)
+                            self.expectedMemory[taskId] = memPerThread * nthreads
+                        else:
+                            self.expectedMemory[taskId] = 0
                         print("Launching task", taskId, command.args, ">", command.out, "2>", command.log)
+                        self.nthreads[taskId] = nthreads
+                        self.writeThreadsFile(taskId)
                         if self.list[taskId].multithreaded:
-                            self.nthreads[taskId] = nbThreads - self.nrun
                             # Creating a new list so that the original list remains available for the Json dump
-                            command = Command(command.args + ["-nbThreads=%d" % self.nthreads[taskId]], command.out, command.log)
-                            print("Using", self.nthreads[taskId], "threads")
-                        else:
-                            self.nthreads[taskId] = 1
-                        self.proc[taskId] = multiprocessing.Process(target=self.goLaunch, args=(taskId, command, status_file))
+                            command = Command(command.args + ["-nbThreads=%d" % nthreads], command.out, command.log)
+                            print("Using", nthreads, "threads")
+                        worker = None
+                        if self.idleWorkers:
+                            worker = self.workers[taskId] = self.idleWorkers.pop()
+                        self.proc[taskId] = multiprocessing.Process(target=self.goLaunch, args=(taskId, command, status_file, nthreads, worker))
                         self.proc[taskId].start()
-                        self.memusage[self.proc[taskId].pid] = 0
-                        self.nrun += self.nthreads[taskId]
+                        self.monitorProcesses(taskId, [self.proc[taskId].pid] + ([worker.pid] if worker and worker.pid else []))
+                        self.nrun += nthreads
+                        self.traceLaunch(taskId, nthreads)
+                        self.relaunched.add(taskId)
                     else:
+                        # Dummy tasks pass the information on to their dependents
+                        if self.list[taskId].dependencies & self.relaunched:
+                            self.relaunched.add(taskId)
                         print("Skipping task", taskId)
+                        self.traceInstant(taskId, "skipped" if command.args else "dummy")
                         self.removeDep(taskId)
                         self.completed += 1
 
         assert self.nrun == 0
+        for worker in self.idleWorkers:
+            worker.stop()
         if not self.failed:
             print("Workflow complete")
-        self.printCPUUsageStats("Workflow report:", start)
+        self.monitorStop.set()
         monitorThread.join()
+        self.printCPUUsageStats("Workflow report:", start)
+        if trace:
+            self.writeTrace(trace)
         return self.failed
 
 class AgoraWorkflow:
@@ -309,6 +1123,7 @@ class AgoraWorkflow:
         'filteredBlocksData': 'filtBlocks/%(filt)s/blocks.%(name)s.list',
         'filteredBlocksLog': 'filtBlocks/%(filt)s/log',
         'geneTreesWithAncNames': 'GeneTreeForest.withAncGenes.nhx.bz2',
+        'geneTreesIndex': 'GeneTreeForest.idx',
         'pairwiseOutput': 'pairwise/pairs-%(filt)s/%(name)s.list',
         'pairwiseLog': 'pairwise/pairs-%(filt)s/log',
         'adjacenciesOutput': 'pairwise/adjacencies-%(filt)s/%(name)s.list',
@@ -319,13 +1134,24 @@ class AgoraWorkflow:
         'ancLog': 'ancBlocks/%(method)s/log',
         'ancGenomesOutput': 'ancGenomes/%(method)s/ancGenome.%(name)s.list',
         'ancGenomesLog': 'ancGenomes/%(method)s/log',
+        'genomeCache': 'genomeCache',
     }
     allAncGenesName = "all"
 
 
-    def __init__(self, defaultRoot, defaultExtantSpeciesFilter, scriptDir, files):
+    # In perAncestor mode, the integration steps are split into one task per ancestor
+    # With binaryOutput, the intermediate files are written in binary formats
+    # With compactGenomes, the steps that load all the genomes use CompactGenome
+    def __init__(self, defaultRoot, defaultExtantSpeciesFilter, scriptDir, files, phylTree=None, perAncestor=False, binaryOutput=False, compactGenomes=False):
         self.defaultRoot = defaultRoot
+        self.extantSpeciesFilter = defaultExtantSpeciesFilter or ""
         self.defaultExtantSpeciesFilter = ["-extantSpeciesFilter=" + defaultExtantSpeciesFilter] if defaultExtantSpeciesFilter else []
+        self.perAncestor = perAncestor
+        self.binaryOutput = ["+binaryOutput"] if binaryOutput else []
+        self.compactGenomes = ["+compactGenomes"] if compactGenomes else []
+        if perAncestor and (phylTree is None):
+            phylTree = myPhylTree.PhylogeneticTree(files["speciesTree"])
+        self.phylTree = phylTree
         self.tasklist = TaskList()
         self.scriptDir = scriptDir
         self.files = files
@@ -342,8 +1168,9 @@ class AgoraWorkflow:
         fixedArgs = [("speciesTree", myTools.FileArgChecker), ("geneTrees|orthologyGroups", myTools.FileOrPatternArgChecker), ("genes", str)]
         optionalArgs = options \
             + [("target", str, ""), ("extantSpeciesFilter", str, "")] \
-            + [("compress", str, ["bz2", "xz", "gz", ""]), ("workingDir", str, "."), ("nbThreads", int, multiprocessing.cpu_count())] \
-            + [("forceRerun", bool, False), ("sequential", bool, True)]
+            + [("compress", str, ["bz2", "xz", "gz", ""]), ("workingDir", str, "."), ("nbThreads", int, None)] \
+            + [("forceRerun", bool, False), ("sequential", bool, None), ("perAncestor", bool, False), ("maxMemory", myTools.MemorySizeArgChecker, 0), ("hashInputs", bool, False), ("backend", str, ["subprocess", "inprocess", "jobdir"]), ("jobDir", str, ""), ("trace", str, "")] \
+            + [("estimate", bool, False), ("costModel", str, ""), ("monitorInterval", float, 5.), ("binaryOutput", bool, False), ("cacheGenomes", bool, False), ("compactGenomes", bool, False)]
         arguments = myTools.checkArgs(fixedArgs, optionalArgs, doc)
 
         # Path configuration
@@ -357,6 +1184,8 @@ class AgoraWorkflow:
             if files[f].endswith('.list') and arguments["compress"]:
                 files[f] = files[f] + '.' + arguments["compress"]
         scriptDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        if not arguments["jobDir"]:
+            arguments["jobDir"] = os.path.join(outputDir, "jobs")
 
         phylTree = myPhylTree.PhylogeneticTree(arguments["speciesTree"])
         # Check that the syntax is correct
@@ -365,13 +1194,145 @@ class AgoraWorkflow:
         if arguments["extantSpeciesFilter"]:
             phylTree.getTargetsSpec(arguments["extantSpeciesFilter"])
 
-        workflow = cls(arguments["target"] or phylTree.root, arguments["extantSpeciesFilter"], scriptDir, files)
+        workflow = cls(arguments["target"] or phylTree.root, arguments["extantSpeciesFilter"], scriptDir, files, phylTree, arguments["perAncestor"], arguments["binaryOutput"], arguments["compactGenomes"])
 
         return (workflow, arguments)
 
+    # Run the tasks with the options of the command line, or only estimate their cost (+estimate)
+    def run(self, arguments):
+        # Sequential mode is the default, unless the user explicitly asks
+        # for a number of threads (-nbThreads defaults to None)
+        if arguments["sequential"] is None:
+            arguments["sequential"] = arguments["nbThreads"] is None
+        if arguments["nbThreads"] is None:
+            arguments["nbThreads"] = multiprocessing.cpu_count()
+        if arguments["estimate"]:
+            self.printEstimate(arguments["nbThreads"], arguments["sequential"], arguments["costModel"])
+            return 0
+        if arguments["cacheGenomes"]:
+            self.tasklist.env[myGenomes.genomeCacheVariable] = os.path.abspath(self.files["genomeCache"])
+        failed = self.tasklist.runAll(arguments["nbThreads"], arguments["sequential"], arguments["forceRerun"], arguments["maxMemory"], arguments["hashInputs"], arguments["backend"], arguments["trace"], arguments["jobDir"], arguments["monitorInterval"])
+        if arguments["costModel"]:
+            self.updateCostModel(arguments["costModel"])
+        return failed
+
+    # Cost model
+    # For each script, the total CPU time and peak memory usage (per thread)
+    # observed in previous runs, together with the corresponding amount of
+    # work (MB of input data x number of ancestors) and of input data (MB).
+    # The cost of a new task is then predicted proportionally
+    ##########################################################################
+
+    # Size (in MB) of the input data of the workflow: extant genomes and gene trees
+    def getInputDataSize(self):
+        paths = glob.glob(self.files["geneTrees|orthologyGroups"].replace("%s", "*"))
+        paths.extend(self.files["genes"] % {"name": self.phylTree.fileName[e]} for e in self.phylTree.listSpecies)
+        return sum(os.path.getsize(path) for path in paths if os.path.isfile(path)) / 1024. / 1024.
+
+    # Number of ancestors the task works on (its target is args[2])
+    def getAncestorCount(self, i):
+        args = self.tasklist.list[i].command.args
+        try:
+            return len(self.phylTree.getTargetsAnc(args[2]))
+        except (IndexError, KeyError):
+            return len(self.phylTree.listAncestr)
+
+    def loadCostModel(self, costModel):
+        if costModel and os.path.exists(costModel):
+            with open(costModel, "r") as fh:
+                return json.load(fh)
+        return {}
+
+    # Add the tasks that have just run to the cost model
+    def updateCostModel(self, costModel):
+        model = self.loadCostModel(costModel)
+        dataSize = self.getInputDataSize()
+        for i in sorted(self.tasklist.relaunched):
+            task = self.tasklist.list[i]
+            status = self.tasklist.readStatusFile(i) if task.command.args else None
+            if not status:
+                continue
+            stats = status["stats"]
+            costs = model.setdefault(os.path.basename(task.command.args[0]), {"work": 0, "cpu_time": 0, "data": 0, "peak_memory": 0})
+            costs["work"] += dataSize * self.getAncestorCount(i)
+            costs["cpu_time"] += stats["cpu_time"]
+            costs["data"] += dataSize
+            costs["peak_memory"] += stats["peak_memory"] / (stats["threads"] if task.multithreaded else 1)
+        print("Updating the cost model", costModel)
+        with open(costModel, "w") as fh:
+            json.dump(model, fh, indent=4, sort_keys=True)
+
+    # Predicted CPU time, memory usage per thread, and parallelism of each task
+    # Tasks that have already run in this working directory keep their own costs
+    def estimateCosts(self, costModel):
+        model = self.loadCostModel(costModel)
+        dataSize = self.getInputDataSize()
+        print("Input data: %g MB" % dataSize)
+        costs = []
+        for (i, task) in enumerate(self.tasklist.list):
+            if not task.command.args:
+                costs.append((0, 0, 1))
+                continue
+            nbAnc = self.getAncestorCount(i)
+            previous = self.tasklist.readStatusFile(i)
+            script = os.path.basename(task.command.args[0])
+            if previous and ("stats" in previous):
+                stats = previous["stats"]
+                costs.append((stats["cpu_time"], stats["peak_memory"] / (stats["threads"] if task.multithreaded else 1), nbAnc))
+            elif script in model:
+                m = model[script]
+                costs.append((m["cpu_time"] / m["work"] * dataSize * nbAnc, m["peak_memory"] / m["data"] * dataSize, nbAnc))
+            else:
+                costs.append((TaskList.defaultTaskDuration, TaskList.memoryEstimateFactor * dataSize * 1024 * 1024, nbAnc))
+        return costs
+
+    def printEstimate(self, nbThreads, sequential, costModel):
+        costs = self.estimateCosts(costModel)
+        schedule = self.tasklist.simulate(nbThreads, sequential, costs)
+        names = self.tasklist.getTaskNames()
+        table = [["task", "name", "threads", "start", "duration", "CPU time", "memory"]]
+        events = []
+        for i in sorted(schedule, key=lambda i: schedule[i]):
+            (start, end, nthreads) = schedule[i]
+            if not self.tasklist.list[i].command.args:
+                continue
+            memory = costs[i][1] * min(nthreads, costs[i][2])
+            table.append([i, names.get(i, ""), nthreads, "%.0fs" % start, "%.0fs" % (end - start), "%.0fs" % costs[i][0], "%.0f MB" % (memory / 1024. / 1024.)])
+            events.append((start, memory))
+            events.append((end, -memory))
+        myTools.printTable(table, sys.stdout)
+        # Ends are processed before starts at the same time
+        peakMemory = max(itertools.accumulate(m for (_, m) in sorted(events)), default=0)
+        print()
+        print("Predicted duration with %d threads%s: %.0f sec" % (nbThreads, " (sequential)" if sequential else "", max((end for (_, end, _) in schedule.values()), default=0)))
+        print("Predicted total CPU time: %.0f sec" % sum(cpu for (cpu, _, _) in costs))
+        print("Predicted peak memory usage: %.0f MB" % (peakMemory / 1024. / 1024.))
+
     def addDummy(self, taskFullName, dependencies=[]):
         return self.tasklist.addTask(taskFullName, dependencies, Command(None, None, None), False)
 
+    # Add a task that processes all the ancestors of its target (args[2]).
+    # In perAncestor mode, it is split into one task per ancestor (named after
+    # the ancestor) that only waits for the same ancestor in the previous steps,
+    # plus a collector task under the original name for the steps that need all
+    # the ancestors
+    def addAncestralTask(self, taskFullName, dependencies, args, logPath, multithreaded, ancestors=None):
+        if not self.perAncestor:
+            return self.tasklist.addTask(taskFullName, dependencies, Command(args, None, logPath), multithreaded)
+
+        if ancestors is None:
+            ancestors = self.phylTree.getTargetsAnc(args[2])
+        subtasks = []
+        for anc in sorted(ancestors):
+            ancDependencies = [dep + (anc,) if (dep + (anc,)) in self.tasklist.dic else dep for dep in dependencies]
+            ancArgs = args[:2] + ["=" + anc] + args[3:]
+            if multithreaded:
+                # The scripts only parallelise over the ancestors
+                ancArgs.append("-nbThreads=1")
+            subtasks.append(taskFullName + (anc,))
+            self.tasklist.addTask(taskFullName + (anc,), ancDependencies, Command(ancArgs, None, logPath + "." + self.phylTree.fileName[anc]), False)
+        return self.addDummy(taskFullName, subtasks)
+
     def addAncGenesGenerationAnalysis(self):
         if "%s" in self.files["geneTrees|orthologyGroups"]:
             taskFullName = (self.ancGenesTaskName, self.allAncGenesName)
@@ -405,10 +1366,14 @@ class AgoraWorkflow:
                         self.files["speciesTree"],
                         self.files["geneTrees|orthologyGroups"],
                         "-OUT.ancGenesFiles=" + self.files["ancGenesData"] % {"filt": self.allAncGenesName, "name": "%s"},
+                        # Kept in the working directory, for the next runs
+                        "-index=" + self.files["geneTreesIndex"],
                     ],
                     self.files["geneTreesWithAncNames"],
                     self.files["ancGenesLog"] % {"filt": "ancGenes"},
-                )
+                ),
+                True,
+                outputs=[self.files["geneTreesIndex"]],
             )
 
     # FIXME: both this and the callers implement their own naming scheme (size-0.9-1.1). Risk is that they diverge
@@ -425,6 +1390,9 @@ class AgoraWorkflow:
                 self.files["filteredBlocksData"] % {"filt": taskName, "name": "%s"},
             ]
             logPath = self.files["filteredBlocksLog"] % {"filt": taskName}
+            params = params + self.binaryOutput
+            # Not given as -OUT.xxx
+            outputs = pathParameters[1:]
         else:
             scriptTemplate = "ALL.filterGeneFamilies-%s.py"
             inputName = self.allAncGenesName
@@ -434,6 +1402,7 @@ class AgoraWorkflow:
                 "-OUT.ancGenesFiles=" + self.files["ancGenesData"] % {"filt": methodName + "-%s", "name": "%s"},
             ]
             logPath = self.files["ancGenesLog"] % {"filt": taskName}
+            outputs = []
 
         return self.tasklist.addTask(
             (self.ancGenesTaskName, taskName),
@@ -446,7 +1415,8 @@ class AgoraWorkflow:
                 ] + pathParameters + params,
                 None,
                 logPath,
-            )
+            ),
+            outputs=outputs,
         )
 
     def addPairwiseAnalysis(self, ancGenesName, methodName=None, params=[], ancestor=None):
@@ -457,6 +1427,7 @@ class AgoraWorkflow:
             ancGenesName = self.blocksName + "-" + ancGenesName
             params.append("-iniAncGenesFiles=" + self.files["ancGenesData"] % {"filt": self.allAncGenesName, "name": "%s"})
             params.append("-LOG.pairwise=" + self.files["adjacenciesDebug"] % {"filt": ancGenesName, "name": "%s"})
+            params.extend(self.compactGenomes)
         else:
             if methodName is None:
                 methodName = "conservedPairs"
@@ -472,7 +1443,7 @@ class AgoraWorkflow:
                     "-ancGenesFiles=" + self.files[self.ancGenesFileEntryName] % {"filt": ancGenesName, "name": "%s"},
                     "-genesFiles=" + self.files["genes"] % {"name": "%s"},
                     "-OUT.pairwise=" + self.files[self.pairwiseFileEntryName] % {"filt": ancGenesName, "name": "%s"}
-                ] + self.defaultExtantSpeciesFilter + params,
+                ] + self.defaultExtantSpeciesFilter + params + self.binaryOutput,
                 None,
                 self.files[self.pairwiseFileEntryName.replace("Output", "Log")] % {"filt": ancGenesName},
             ),
@@ -550,24 +1521,32 @@ class AgoraWorkflow:
         if methodName == "scaffolds":
             args.append("-genesFiles=" + self.files["genes"] % {"name": "%s"})
             args.extend(self.defaultExtantSpeciesFilter)
+            args.extend(self.compactGenomes)
 
         if methodName != "copy":
             args.append("-LOG.ancGraph=" + self.files["ancGraphs"] % {"method": newMethod, "name": "%s"})
 
+        # The support scores written by "scaffolds" can only be stored as text
+        if methodName not in ["copy", "scaffolds"]:
+            args.extend(self.binaryOutput)
+
         # Most of the methods are multithreaded
         multithreaded = methodName not in ["copy"]
 
+        # Scaffolds can only work on the ancestors that are between two extant species
+        ancestors = None
+        if self.perAncestor and (methodName == "scaffolds"):
+            ancestors = self.phylTree.getTargetsForPairwise(ancestor, self.extantSpeciesFilter)[1]
+
         self.prevMethod = newMethod
 
-        return self.tasklist.addTask(
+        return self.addAncestralTask(
             ("integr", newMethod),
             dep,
-            Command(
-                args,
-                None,
-                logfile % {"method": newMethod},
-            ),
+            args,
+            logfile % {"method": newMethod},
             multithreaded,
+            ancestors,
         )
 
 
@@ -612,14 +1591,11 @@ class AgoraWorkflow:
                 "-OUT.ancGenomes=" + self.files["ancGenomesOutput"] % {"method": outputName, "name": "%s"},
         ]
 
-        return self.tasklist.addTask(
+        return self.addAncestralTask(
             ("conversion", outputName),
             [("integr", self.prevMethod)],
-            Command(
-                args,
-                None,
-                self.files["ancGenomesLog"] % {"method": outputName},
-            ),
+            args,
+            self.files["ancGenomesLog"] % {"method": outputName},
             True,
         )
 
@@ -678,18 +1654,15 @@ class AgoraWorkflow:
                 "-IN.blocksBlocksFile=" + self.files["ancBlocks"] % {"method": self.prevMethod, "name": "%s"},
                 "-IN.blocksGenesFile=" + self.files["filteredBlocksData"] % {"filt": self.blocksName + "-" + self.allAncGenesName, "name": "%s"},
                 "-OUT.ancBlocksFile=" + self.files["ancBlocks"] % {"method": newMethod, "name": "%s"},
-        ]
+        ] + self.binaryOutput
 
         self.prevMethod = newMethod
 
-        return self.tasklist.addTask(
+        return self.addAncestralTask(
             ("integr", newMethod),
             deps,
-            Command(
-                args,
-                None,
-                self.files["ancLog"] % {"method": newMethod},
-            ),
+            args,
+            self.files["ancLog"] % {"method": newMethod},
             True,
         )
 
@@ -736,14 +1709,12 @@ class AgoraWorkflow:
                 "-OUT.ancBlocks=" + self.files["ancBlocks"] % {"method": newMethod, "name": "%s"},
         ] + [self.files["ancBlocks"] % {"method": method, "name": "%s"} for (_, method) in self.selectionPool]
 
-        task = self.tasklist.addTask(
+        task = self.addAncestralTask(
             ("integr", newMethod),
             self.selectionPool,
-            Command(
-                args,
-                None,
-                self.files["ancLog"] % {"method": newMethod},
-            ),
+            args,
+            self.files["ancLog"] % {"method": newMethod},
+            False,
         )
         self.prevMethod = newMethod
         self.selectionPool = []
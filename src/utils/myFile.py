@@ -8,9 +8,12 @@
 
 # file management functions
 
+import codecs
 import itertools
 import collections
+import io
 import os
+import re
 import subprocess
 import sys
 
@@ -162,7 +165,7 @@ def openFile(nom, mode):
         # Compression bzip2
         elif nom.endswith(".bz2"):
             import bz2
-            f = bz2.open(nom, mode)
+            f = openParallel(nom, mode, "bz2") or bz2.open(nom, mode)
         # Compression gzip
         elif nom.endswith(".gz"):
             import gzip
@@ -170,7 +173,445 @@ def openFile(nom, mode):
         # Compression lzma
         elif nom.endswith(".lzma") or nom.endswith(".xz"):
             import lzma
-            f = lzma.open(nom, mode)
+            f = openParallel(nom, mode, "xz") or lzma.open(nom, mode)
         else:
             f = open(nom, mode)
     return f
+
+
+# compressed file (in a format openFile can write)
+def isCompressed(nom):
+    return nom.endswith((".bz2", ".gz", ".lzma", ".xz"))
+
+
+# command-line compressors, writing the same formats as openFile
+# (lzma.open writes .xz-formatted data, whatever the extension)
+nativeCompressors = [
+    (".bz2", ["bzip2", "-c", "-9"]),
+    (".gz", ["gzip", "-c", "-9"]),
+    (".lzma", ["xz", "-c"]),
+    (".xz", ["xz", "-c"]),
+]
+
+# return the command that compresses its stdin to its stdout for this file name
+# None if the file is not compressed or the program is not installed
+def getNativeCompressor(nom):
+    import shutil
+    for (ext, comm) in nativeCompressors:
+        if nom.endswith(ext):
+            return comm if shutil.which(comm[0]) else None
+    return None
+
+
+# Binary columns of 32-bit integers (little-endian): the number of values per
+# column (64 bits) followed by the columns, one after the other
+def writeInt32Columns(f, columns):
+    import array
+    f.write(len(columns[0]).to_bytes(8, "little"))
+    for column in columns:
+        column = array.array("i", column)
+        assert column.itemsize == 4
+        if sys.byteorder != "little":
+            column.byteswap()
+        f.write(column.tobytes())
+
+# Returns the columns as arrays
+def readInt32Columns(f, nbColumns):
+    import array
+    n = int.from_bytes(f.read(8), "little")
+    columns = []
+    for _ in range(nbColumns):
+        column = array.array("i")
+        column.frombytes(f.read(4 * n))
+        if len(column) != n:
+            raise EOFError("Truncated binary file")
+        if sys.byteorder != "little":
+            column.byteswap()
+        columns.append(column)
+    return columns
+
+# Open a file that is either in a binary format starting with this magic
+# string, or in text. Returns (True, f) with f positioned after the magic
+# string, or (False, f) with f opened in text mode. The file is only opened once
+def openBinaryOrText(nom, magic):
+    f = openFile(nom, "rb")
+    if isinstance(f, io.TextIOBase):
+        return (False, f)
+    if f.peek(len(magic))[:len(magic)] == magic:
+        f.read(len(magic))
+        return (True, f)
+    return (False, io.TextIOWrapper(f))
+
+
+# Parallel compression and decompression (like pbzip2)
+# The data is compressed by blocks in a pool of threads, each block as an
+# independent stream. The bz2 and xz formats allow concatenated streams, so
+# such files can be read by any program. When reading them, the streams are
+# decompressed in parallel too. Other files are read the usual way
+# The number of threads comes from the AGORA_COMPRESSION_THREADS environment
+# variable (1, i.e. no parallel compression, by default)
+compressionThreads = int(os.environ.get("AGORA_COMPRESSION_THREADS", "1"))
+
+# magic: the beginning of a stream
+# blockSize: amount of uncompressed data per stream
+parallelCodec = collections.namedtuple("parallelCodec", ["compress", "decompressor", "magic", "blockSize"])
+
+def getParallelCodec(name):
+    if name == "bz2":
+        import bz2
+        # Header followed by the magic of either a block or the end of the stream
+        return parallelCodec(lambda data: bz2.compress(data, 9), bz2.BZ2Decompressor, re.compile(b"BZh[1-9](?:1AY&SY|\x17rE8P\x90)"), 900000)
+    else:
+        import lzma
+        # Smaller blocks compress less well
+        return parallelCodec(lambda data: lzma.compress(data, lzma.FORMAT_XZ), lzma.LZMADecompressor, re.compile(b"\xfd7zXZ\x00"), 8 * 1024 * 1024)
+
+# Return None if the file has to be opened the usual way
+def openParallel(nom, mode, codecName):
+    if (compressionThreads <= 1) or ("a" in mode) or ("x" in mode) or ("+" in mode):
+        return None
+    codec = getParallelCodec(codecName)
+    if "w" in mode:
+        f = io.BufferedWriter(ParallelCompressedWriter(open(nom, "wb"), codec, compressionThreads), codec.blockSize)
+    else:
+        f = ParallelCompressedReader.open(nom, codec, compressionThreads)
+        if f is None:
+            return None
+        f = io.BufferedReader(f, io.DEFAULT_BUFFER_SIZE * 16)
+    if "b" not in mode:
+        f = io.TextIOWrapper(f)
+    return f
+
+
+class ParallelCompressedWriter(io.RawIOBase):
+
+    def __init__(self, fileobj, codec, threads):
+        import concurrent.futures
+        self.fileobj = fileobj
+        self.codec = codec
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        # Blocks being compressed, in the order of the file
+        self.pending = collections.deque()
+        self.maxPending = 2 * threads
+        self.buffer = bytearray()
+        self.nbBlocks = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.codec.blockSize:
+            self.submit(bytes(self.buffer[:self.codec.blockSize]))
+            del self.buffer[:self.codec.blockSize]
+        return len(data)
+
+    def submit(self, data):
+        self.pending.append(self.pool.submit(self.codec.compress, data))
+        self.nbBlocks += 1
+        while len(self.pending) > self.maxPending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if not self.closed:
+            # An empty file still needs one (empty) stream
+            if self.buffer or not self.nbBlocks:
+                self.submit(bytes(self.buffer))
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+            self.pool.shutdown()
+            self.fileobj.close()
+        super().close()
+
+
+class ParallelCompressedReader(io.RawIOBase):
+
+    # Amount of compressed data read at once
+    chunkSize = 16 * 1024 * 1024
+
+    # Return None if the file doesn't start with several streams
+    @classmethod
+    def open(cls, nom, codec, threads):
+        fileobj = open(nom, "rb")
+        chunk = fileobj.read(cls.chunkSize)
+        if codec.magic.match(chunk) and codec.magic.search(chunk, 1):
+            return cls(fileobj, codec, threads, chunk)
+        fileobj.close()
+        return None
+
+    def __init__(self, fileobj, codec, threads, chunk):
+        import concurrent.futures
+        self.fileobj = fileobj
+        self.codec = codec
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self.maxPending = 2 * threads
+        self.reset(chunk)
+
+    def reset(self, chunk):
+        # Compressed data not submitted yet
+        self.buffer = chunk
+        self.eof = False
+        # Streams being decompressed: (compressed data, future)
+        self.pending = collections.deque()
+        self.data = b""
+        self.offset = 0
+        self.position = 0
+
+    # Returns the decompressed data, and whether it was exactly one or several complete streams
+    def decompress(self, data):
+        output = []
+        try:
+            while True:
+                decompressor = self.codec.decompressor()
+                output.append(decompressor.decompress(data))
+                if not decompressor.eof:
+                    return (b"".join(output), False)
+                data = decompressor.unused_data
+                if not data:
+                    return (b"".join(output), True)
+        except (OSError, EOFError, ValueError):
+            return (b"", False)
+
+    # Split the compressed data into streams, and submit them
+    def fill(self):
+        while (len(self.pending) < self.maxPending) and not (self.eof and not self.buffer):
+            match = self.codec.magic.search(self.buffer, 1)
+            if match:
+                stream = self.buffer[:match.start()]
+                self.buffer = self.buffer[match.start():]
+            elif self.eof:
+                (stream, self.buffer) = (self.buffer, b"")
+            else:
+                chunk = self.fileobj.read(self.chunkSize)
+                if chunk:
+                    self.buffer += chunk
+                else:
+                    self.eof = True
+                continue
+            self.pending.append((stream, self.pool.submit(self.decompress, stream)))
+
+    # Next block of decompressed data, b"" at the end of the file
+    def nextData(self):
+        self.fill()
+        if not self.pending:
+            return b""
+        (stream, future) = self.pending.popleft()
+        (data, complete) = future.result()
+        # The magic string can also appear by chance in the compressed data.
+        # The stream then continues in the next piece(s)
+        while not complete:
+            self.fill()
+            if not self.pending:
+                raise OSError("Invalid or truncated compressed data in " + self.fileobj.name)
+            stream += self.pending.popleft()[0]
+            (data, complete) = self.decompress(stream)
+        return data
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.offset >= len(self.data):
+            self.data = self.nextData()
+            self.offset = 0
+            if not self.data and not self.pending and self.eof and not self.buffer:
+                return 0
+        n = min(len(b), len(self.data) - self.offset)
+        b[:n] = self.data[self.offset:self.offset + n]
+        self.offset += n
+        self.position += n
+        return n
+
+    # Only rewinding is possible
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if (offset, whence) == (self.position, io.SEEK_SET) or (offset, whence) == (0, io.SEEK_CUR):
+            return self.position
+        if (offset, whence) != (0, io.SEEK_SET):
+            raise io.UnsupportedOperation("can only rewind")
+        for (_, future) in self.pending:
+            future.cancel()
+        self.fileobj.seek(0)
+        self.reset(self.fileobj.read(self.chunkSize))
+        return 0
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.pool.shutdown(wait=False)
+            self.fileobj.close()
+        super().close()
+
+
+# Decompressor objects for the formats of openFile (None for other files)
+def getDecompressor(nom):
+    if nom.endswith(".bz2"):
+        import bz2
+        return bz2.BZ2Decompressor()
+    elif nom.endswith(".gz"):
+        import zlib
+        return zlib.decompressobj(wbits=31)
+    elif nom.endswith(".lzma") or nom.endswith(".xz"):
+        import lzma
+        return lzma.LZMADecompressor()
+    return None
+
+
+# Iterate over the lines of a file, which a background thread reads and
+# decompresses in advance, by blocks of chunkSize bytes. Like openFile(nom, "r")
+# The thread decompresses each block in a single call, which releases the GIL
+# for the whole block. Other sources (e.g. open files) are read as text by the
+# thread, which only helps when reading them releases the GIL
+def prefetchLines(nom, chunkSize=1024*1024, maxChunks=8):
+    import locale
+    import queue
+    import threading
+
+    local = isinstance(nom, str) and os.path.isfile(os.path.expanduser(nom)) and (not isCompressed(nom) or (compressionThreads <= 1))
+    if local:
+        f = open(os.path.expanduser(nom), "rb")
+        decompressor = getDecompressor(nom)
+    else:
+        f = openFile(nom, "r")
+        decompressor = None
+
+    chunks = queue.Queue(maxChunks)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def reader():
+        nonlocal decompressor
+        try:
+            # Whether the current stream has started
+            inStream = False
+            while not stop.is_set():
+                chunk = f.read(chunkSize)
+                if decompressor is not None:
+                    if not chunk:
+                        if inStream:
+                            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+                        break
+                    data = []
+                    while chunk:
+                        data.append(decompressor.decompress(chunk))
+                        inStream = True
+                        # Concatenated streams
+                        if decompressor.eof:
+                            chunk = decompressor.unused_data
+                            decompressor = getDecompressor(nom)
+                            inStream = False
+                        else:
+                            chunk = b""
+                    put(b"".join(data))
+                else:
+                    put(chunk)
+                    if not chunk:
+                        break
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        # Same decoding and translation of the newlines as io.TextIOWrapper
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(locale.getpreferredencoding(False))(), True) if local else None
+        rest = ""
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if chunk is None:
+                if decoder:
+                    rest += decoder.decode(b"", final=True)
+                break
+            lines = (rest + (decoder.decode(chunk) if decoder else chunk)).split("\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if rest:
+            yield rest
+    finally:
+        # Also when the consumer stops early
+        stop.set()
+        thread.join()
+        f.close()
+
+
+# Iterate over the decompressed content of a file, from the compressed stream
+# that starts at this offset. Yields (offset of the stream in the file,
+# position of the data in the stream, data). Each piece of data lies in a single
+# stream. Uncompressed files are seen as a series of chunkSize-long streams
+def readStreams(nom, offset=0, chunkSize=1024*1024):
+    nom = os.path.expanduser(nom)
+    with open(nom, "rb") as f:
+        f.seek(offset)
+        decompressor = getDecompressor(nom)
+        position = 0
+        while True:
+            chunk = f.read(chunkSize)
+            if decompressor is None:
+                if not chunk:
+                    break
+                yield (offset, 0, chunk)
+                offset += len(chunk)
+                continue
+            if not chunk:
+                if position or (f.tell() != offset):
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+                break
+            # Offset of the chunk in the file
+            start = f.tell() - len(chunk)
+            while chunk:
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield (offset, position, data)
+                    position += len(data)
+                if decompressor.eof:
+                    # Concatenated streams
+                    start += len(chunk) - len(decompressor.unused_data)
+                    chunk = decompressor.unused_data
+                    (offset, position) = (start, 0)
+                    decompressor = getDecompressor(nom)
+                else:
+                    chunk = b""
+
+
+# Iterate over the lines of a file (as bytes), skipping the first skip bytes
+# of the compressed stream that starts at this offset (see readStreams).
+# Yields (offset of the stream, position of the line in the stream, line)
+def readLinesAt(nom, offset=0, skip=0):
+    rest = []
+    for (offset, position, data) in readStreams(nom, offset):
+        if skip:
+            n = min(skip, len(data))
+            (data, position, skip) = (data[n:], position + n, skip - n)
+            if not data:
+                continue
+        # Beginning of the current line
+        if not rest:
+            (lineOffset, linePosition) = (offset, position)
+        start = 0
+        end = data.find(b"\n") + 1
+        while end:
+            rest.append(data[start:end])
+            yield (lineOffset, linePosition, b"".join(rest))
+            rest = []
+            (lineOffset, linePosition) = (offset, position + end)
+            start = end
+            end = data.find(b"\n", start) + 1
+        if start < len(data):
+            rest.append(data[start:])
+    if rest:
+        yield (lineOffset, linePosition, b"".join(rest))
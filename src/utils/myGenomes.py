@@ -7,8 +7,14 @@
 # Licences GLP v3 and CeCILL v2
 
 import sys
+import array
+import bisect
 import itertools
 import collections
+import collections.abc
+import hashlib
+import os
+import pickle
 
 from . import myFile
 from . import myTools
@@ -137,22 +143,212 @@ aa2codon = collections.defaultdict(list)
 for (c,p) in codon2aa.items():
     aa2codon[p].append(c)
 
+# Binary format of the ancestral blocks: this magic string, the name of the
+# ancestor, and three groups of columns (see myFile.writeInt32Columns):
+# the number of genes and of weights of each block, then the genes and their
+# strands, then the weights, all the blocks being concatenated
+ancBlocksMagic = b"AGORABL1"
+
+# blocks is a list of (genes, strands, weights)
+def saveAncBlocks(filename, anc, blocks, binary=False):
+    if binary:
+        f = myFile.openFile(filename, "wb")
+        f.write(ancBlocksMagic)
+        name = anc.encode()
+        f.write(len(name).to_bytes(8, "little"))
+        f.write(name)
+        myFile.writeInt32Columns(f, [[len(b[0]) for b in blocks], [len(b[2]) for b in blocks]])
+        myFile.writeInt32Columns(f, [[x for b in blocks for x in b[0]], [x for b in blocks for x in b[1]]])
+        myFile.writeInt32Columns(f, [[x for b in blocks for x in b[2]]])
+    else:
+        f = myFile.openFile(filename, "w")
+        for (genes, strands, weights) in blocks:
+            print(myFile.myTSV.printLine([anc, len(genes), myFile.myTSV.printLine(genes, " "),
+                                          myFile.myTSV.printLine(strands, " "), myFile.myTSV.printLine(weights, " ")]), file=f)
+    f.close()
+
+# Read the rest of a binary file, after the magic string
+def readAncBlocks(f):
+    anc = f.read(int.from_bytes(f.read(8), "little")).decode()
+    (nbGenes, nbWeights) = myFile.readInt32Columns(f, 2)
+    (genes, strands) = myFile.readInt32Columns(f, 2)
+    (weights,) = myFile.readInt32Columns(f, 1)
+    blocks = []
+    i = j = 0
+    for (n, m) in zip(nbGenes, nbWeights):
+        blocks.append((genes[i:i+n].tolist(), strands[i:i+n].tolist(), weights[j:j+m].tolist()))
+        i += n
+        j += m
+    return (anc, blocks)
+
+# Returns the name of the ancestor and the list of (genes, strands, weights)
+# The binary format is detected automatically
+def loadAncBlocks(filename):
+    (binary, f) = myFile.openBinaryOrText(filename, ancBlocksMagic)
+    if binary:
+        (anc, blocks) = readAncBlocks(f)
+    else:
+        anc = None
+        blocks = []
+        for l in f:
+            t = l.split("\t")
+            anc = t[0]
+            blocks.append(([int(x) for x in t[2].split()], [int(x) for x in t[3].split()], [int(x) for x in t[4].split()]))
+    f.close()
+    return (anc, blocks)
+
+# Returns the number of genes of each block, without loading the blocks
+def loadAncBlocksSizes(filename):
+    (binary, f) = myFile.openBinaryOrText(filename, ancBlocksMagic)
+    if binary:
+        f.read(int.from_bytes(f.read(8), "little"))
+        sizes = myFile.readInt32Columns(f, 2)[0].tolist()
+    else:
+        sizes = [int(l.split("\t")[1]) for l in f]
+    f.close()
+    return sizes
+
+# Dense integer ids for the gene names, which take less memory than the names
+# themselves. Genome, CompactGenome and the gene tree loaders store the ids
+# instead of the names when given a registry (names=...), so that the scripts
+# can work on integers and only get the names back (getName) for their output.
+# The registry can be saved to a file (one name per line) and loaded back with
+# the same ids
+class GeneNameRegistry:
+
+    def __init__(self, filename=None):
+        self.names = []
+        self.ids = {}
+        if filename and os.path.exists(filename):
+            f = myFile.openFile(filename, "r")
+            for l in f:
+                self.getId(l[:-1])
+            f.close()
+
+    # The id of the name, which is added if needed
+    def getId(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    # The id of the name, if it has one
+    def get(self, name, default=None):
+        return self.ids.get(name, default)
+
+    def getName(self, i):
+        return self.names[i]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    # Written atomically, as several scripts may share the same file
+    def save(self, filename):
+        (root, ext) = os.path.splitext(filename)
+        tmpName = "%s.%d.tmp%s" % (root, os.getpid(), ext)
+        f = myFile.openFile(tmpName, "w")
+        for name in self.names:
+            print(name, file=f)
+        f.close()
+        os.replace(tmpName, filename)
+
+# Environment variable with the directory of the cache of parsed genomes (see Genome.load)
+genomeCacheVariable = "AGORA_GENOME_CACHE"
+
 # general class for genomes
 class Genome:
 
+    # Bumped when the attributes stored in the cache change
+    cacheVersion = 1
+
+    # Applied to the gene names, replaced with GeneNameRegistry.getId when
+    # the genome is given a registry (names=...)
+    internName = staticmethod(sys.intern)
+
+    # Load a genome, reusing the result of a previous parsing of the same file
+    # (same path, size and modification time) stored in cache_dir, by default
+    # the directory given by the AGORA_GENOME_CACHE environment variable.
+    # Genomes built on top of ancestral genes are not cached. With a
+    # GeneNameRegistry, the names are replaced with their ids after the caching
+    @classmethod
+    def load(cls, fichier, cache_dir=None, **kwargs):
+        cache_dir = cache_dir or os.environ.get(genomeCacheVariable)
+        if (not cache_dir) or (not isinstance(fichier, str)) or ("ancGenes" in kwargs) or (not os.path.isfile(fichier)):
+            return cls(fichier, **kwargs)
+        names = kwargs.pop("names", None)
+        st = os.stat(fichier)
+        key = (os.path.abspath(fichier), st.st_size, st.st_mtime_ns, cls.cacheVersion)
+        cachePath = os.path.join(cache_dir, "%s.%s.pickle" % (os.path.basename(fichier), hashlib.sha1(repr(key).encode()).hexdigest()))
+        try:
+            with open(cachePath, "rb") as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            genome = cls(fichier, **kwargs)
+            state = {k: v for (k, v) in genome.__dict__.items() if k in ["lstGenes", "name", "ancName", "support"]}
+            # Written atomically, as several scripts may load the same genome at the same time
+            os.makedirs(cache_dir, exist_ok=True)
+            tmpPath = "%s.%d.tmp" % (cachePath, os.getpid())
+            with open(tmpPath, "wb") as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpPath, cachePath)
+            if names is None:
+                return genome
+            # The genome built above may be shared (see InProcessWorker.installCaches)
+            # and must not be changed: the ids go into a new one
+            genome = object.__new__(cls)
+            genome.__dict__.update(state)
+        else:
+            print("Loading genome of", fichier, "from the cache ...", end=' ', file=sys.stderr)
+            # Not cls.__new__, which may be overridden (see InProcessWorker.installCaches)
+            genome = object.__new__(cls)
+            genome.__dict__.update(state)
+            print("OK", file=sys.stderr)
+        if names is not None:
+            genome.internName = names.getId
+            genome.lstGenes = collections.defaultdict(list, ((chrom, [gene._replace(names=tuple(names.getId(s) for s in gene.names)) for gene in l]) for (chrom, l) in genome.lstGenes.items()))
+        genome.init(**kwargs)
+        return genome
+
     # builder
     def __init__(self, fichier, **kwargs):
 
+        if kwargs.get("names") is not None:
+            self.internName = kwargs["names"].getId
+
         if isinstance(fichier, str):
             print("Loading genome of", fichier, "...", end=' ', file=sys.stderr)
-            f = myFile.firstLineBuffer(myFile.openFile(fichier, 'r'))
+            (binary, f) = myFile.openBinaryOrText(fichier, ancBlocksMagic)
+            if not binary:
+                f = myFile.firstLineBuffer(f)
+                c = f.firstLine.split("\t")
 
             # list of genes per chromosome
             self.lstGenes = collections.defaultdict(list)
             info = False
             # choice of the loading function
-            c = f.firstLine.split("\t")
-            if f.firstLine.startswith(">") or f.firstLine.endswith("$"):
+            if binary:
+                # ancestral genome: binary version of "ANC LEN LST-INDEX LST-STRANDS LST-WEIGHTS"
+                ##################################################################################
+                (self.ancName, blocks) = readAncBlocks(f)
+                if 'ancGenes' in kwargs:
+                    ancGenes = kwargs["ancGenes"].lstGenes[None]
+                self.support = {}
+                for (i,(genes,strands,weights)) in enumerate(blocks):
+                    chrom = i+1
+                    lchrom = self.lstGenes[chrom]
+                    self.support[chrom] = [str(x) for x in weights]
+                    for (pos,(index,strand)) in enumerate(zip(genes, strands)):
+                        if 'ancGenes' in kwargs:
+                            lchrom.append( Gene(chrom, pos, pos+1, strand, ancGenes[index].names) )
+                        else:
+                            lchrom.append( Gene(chrom, pos, pos+1, strand, (index,) ) )
+                print("(ancestral genome: binary diags)", end=' ', file=sys.stderr)
+
+            elif f.firstLine.startswith(">") or f.firstLine.endswith("$"):
                 # GRIMM-Synteny format
                 ######################
                 if f.firstLine.startswith(">"):
@@ -172,7 +368,7 @@ class Genome:
                 # ancestral genes: "NAMES"
                 ##########################
                 for (i,l) in enumerate(f):
-                    self.lstGenes[None].append( Gene(None, i, i+1, 0, tuple(sys.intern(x) for x in l.split())) )
+                    self.lstGenes[None].append( Gene(None, i, i+1, 0, tuple(self.internName(x) for x in l.split())) )
                 print("(ancestral genes)", end=' ', file=sys.stderr)
 
             elif (len(c) == 2) and not set(c[1]).issubset("01-"):
@@ -322,7 +518,7 @@ class Genome:
         # FIXME : 0 ?
         assert strand in {-1, 0, 1, None}
         chromosome = commonChrName(chromosome)
-        self.lstGenes[chromosome].append(Gene(chromosome, beg, end, strand, tuple(sys.intern(s) for s in names)) )
+        self.lstGenes[chromosome].append(Gene(chromosome, beg, end, strand, tuple(self.internName(s) for s in names)) )
 
     # return genes in the chromosome that are between beg and end base pairs
     def getGenesAt(self, chr, beg, end, onlyInside=False):
@@ -454,3 +650,140 @@ class Genome:
         else:
             densityInConsideredGenes = None
         return (chromosomesMeanInterConsideredGeneLen, densityInConsideredGenes)
+
+
+
+# Compact version of Genome, for the scripts that keep many genomes in memory
+# The genes are stored in arrays (one per column and per chromosome) and their
+# names as integers in a GeneNameRegistry shared by all the compact genomes.
+# lstGenes, dicGenes, chrList, getPositions, iteration etc. work as with Genome,
+# the Gene and GenePosition objects being built on demand. The genome cannot be
+# modified. With names=registry, the names are the ids of that registry, like
+# with Genome
+class CompactGenome(Genome):
+
+    # Shared by all the instances
+    nameRegistry = GeneNameRegistry()
+    # Code of the "None" strand in the arrays
+    noStrand = -128
+
+    # Same parameters as Genome.load
+    @classmethod
+    def load(cls, fichier, cache_dir=None, **kwargs):
+        withDict = kwargs.pop("withDict", True)
+        return cls(Genome.load(fichier, cache_dir, withDict=False, **kwargs), withDict=withDict, names=kwargs.get("names"))
+
+    # Built from a Genome, or from a file like a Genome
+    def __init__(self, genome, **kwargs):
+        withDict = kwargs.pop("withDict", True)
+        if isinstance(genome, str):
+            genome = Genome(genome, withDict=False, **kwargs)
+        self.name = genome.name
+        for attr in ["ancName", "support"]:
+            if hasattr(genome, attr):
+                setattr(self, attr, getattr(genome, attr))
+
+        # The names are already ids when a registry is given
+        if kwargs.get("names") is not None:
+            self.names = None
+            getId = int
+        else:
+            self.names = self.nameRegistry
+            getId = self.nameRegistry.getId
+
+        self.lstGenes = {}
+        for (chrom, l) in genome.lstGenes.items():
+            c = CompactChromosome(chrom, self.names)
+            c.beginnings = array.array("q", (g.beginning for g in l))
+            c.ends = array.array("q", (g.end for g in l))
+            c.strands = array.array("b", (self.noStrand if g.strand is None else g.strand for g in l))
+            c.nameIds = array.array("i", (getId(s) for g in l for s in g.names))
+            c.nameOffsets = array.array("i", itertools.accumulate(itertools.chain([0], (len(g.names) for g in l))))
+            self.lstGenes[chrom] = c
+        self.init(withDict=withDict)
+
+    def init(self, **kwargs):
+        self.dicGenes = CompactGeneDict(self.lstGenes, self.names) if kwargs.get("withDict", True) else {}
+        self.chrList = collections.defaultdict(list)
+        self.chrSet = collections.defaultdict(set)
+        for chrom in self.lstGenes:
+            t = contigType(chrom)
+            self.chrList[t].append(chrom)
+            self.chrSet[t].add(chrom)
+        for t in self.chrList:
+            self.chrList[t].sort(key=lambda c: (isinstance(c, str), c))
+
+
+# Genes of one chromosome of a CompactGenome, seen as a list of Gene
+# names is the GeneNameRegistry of the name ids, or None to return the ids
+class CompactChromosome(collections.abc.Sequence):
+
+    def __init__(self, chrom, names):
+        self.chrom = chrom
+        self.names = names
+
+    def __len__(self):
+        return len(self.beginnings)
+
+    def getNames(self, i):
+        ids = self.nameIds[self.nameOffsets[i]:self.nameOffsets[i+1]]
+        if self.names is None:
+            return tuple(ids)
+        return tuple(self.names.getName(x) for x in ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        strand = self.strands[i]
+        return Gene(self.chrom, self.beginnings[i], self.ends[i], None if strand == CompactGenome.noStrand else strand, self.getNames(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+# dicGenes of a CompactGenome: the positions of the genes sorted by name id
+class CompactGeneDict(collections.abc.Mapping):
+
+    def __init__(self, lstGenes, names):
+        self.names = names
+        self.chromosomes = list(lstGenes)
+        positions = {}
+        for (ic, chrom) in enumerate(self.chromosomes):
+            c = lstGenes[chrom]
+            for i in range(len(c)):
+                for x in c.nameIds[c.nameOffsets[i]:c.nameOffsets[i+1]]:
+                    # Like in Genome, the last occurrence of a name wins
+                    positions[x] = (ic, i)
+        ids = sorted(positions)
+        self.ids = array.array("i", ids)
+        self.chromIndices = array.array("i", (positions[x][0] for x in ids))
+        self.indices = array.array("i", (positions[x][1] for x in ids))
+
+    def find(self, name):
+        x = name if self.names is None else self.names.get(name)
+        if x is None:
+            return -1
+        k = bisect.bisect_left(self.ids, x)
+        if (k < len(self.ids)) and (self.ids[k] == x):
+            return k
+        return -1
+
+    def __getitem__(self, name):
+        k = self.find(name)
+        if k < 0:
+            raise KeyError(name)
+        return GenePosition(self.chromosomes[self.chromIndices[k]], self.indices[k])
+
+    def __contains__(self, name):
+        return self.find(name) >= 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        if self.names is None:
+            return iter(self.ids)
+        return (self.names.getName(x) for x in self.ids)
@@ -23,9 +23,32 @@ from . import myTools
 OrthosFilterType = myTools.Enum('NoFilter', 'InCommonAncestor', 'InBothSpecies')
 
 
+# Binary format of the pairwise files: this magic string followed by five
+# columns (gene1, strand1, gene2, strand2, weight), see myFile.writeInt32Columns
+pairwiseMagic = b"AGORAPW1"
+
+# pairs is an iterable of (gene1, strand1, gene2, strand2, weight). The text
+# format is written as it goes, the binary one needs all the pairs at once
+def saveConservedPairsAnc(filename, pairs, binary=False):
+	if binary:
+		pairs = list(pairs)
+		f = myFile.openFile(filename, "wb")
+		f.write(pairwiseMagic)
+		myFile.writeInt32Columns(f, list(zip(*pairs)) if pairs else [[]] * 5)
+	else:
+		f = myFile.openFile(filename, "w")
+		for pair in pairs:
+			print(myFile.myTSV.printLine(pair), file=f)
+	f.close()
+
+# The binary format is detected automatically
 def loadConservedPairsAnc(filename):
+	(binary, f) = myFile.openBinaryOrText(filename, pairwiseMagic)
+	if binary:
+		columns = myFile.readInt32Columns(f, 5)
+		f.close()
+		return [((g1, s1), (g2, s2), w) for (g1, s1, g2, s2, w) in zip(*columns)]
 	pairwiseDiags = []
-	f = myFile.openFile(filename, "r")
 	for l in f:
 		t = l.split("\t")
 		pairwiseDiags.append(((int(t[0]), int(t[1])), (int(t[2]), int(t[3])), int(t[4])))
@@ -55,19 +78,14 @@ def loadIntegr(filename):
 	integr = []
 	singletons = set()
 	print("Loading ancestral blocks of %s ..." % filename, end=' ', file=sys.stderr)
-	f = myFile.openFile(filename, "r")
-	for l in f:
-		t = l.split("\t")
-		diagA = [int(x) for x in t[2].split()]
-		diagS = [int(x) for x in t[3].split()]
-		diagW = [int(x) for x in t[4].split()]
+	(_, blocks) = myGenomes.loadAncBlocks(filename)
+	for (diagA, diagS, diagW) in blocks:
 		assert len(diagA) == len(diagS)
 		assert len(diagA) == (len(diagW)+1)
 		if len(diagA) == 1:
 			singletons.update(diagA)
 		else:
 			integr.append((list(zip(diagA,diagS)),diagW))
-	f.close()
 	print(myMaths.myStats.txtSummary([len(x[0]) for x in integr]), "+", len(singletons), "singletons OK", file=sys.stderr)
 	return (integr,singletons)
 
@@ -6,8 +6,13 @@
 # mail : agora@bio.ens.psl.eu
 # Licences GLP v3 and CeCILL v2
 
+import ast
+import os
 import sys
+import itertools
 import collections
+import json
+import re
 
 from . import myPhylTree
 from . import myTools
@@ -66,23 +71,51 @@ class ProteinTree:
         self.backInfo = dict((node,values.copy()) for (node,values) in self.info.items())
 
 
+    # Walk the subtree of node with an explicit stack instead of recursive
+    # calls, so that there is no limit on the depth of the tree
+    # Yields (node, parent, length of the branch, True) when entering a node,
+    # and (node, parent, length, False) when leaving it, once all its children
+    # have been left. The children are read after the node has been entered,
+    # so the walk follows the changes made at that point, as a recursive
+    # function would
+    def walk(self, node=None):
+        node = self.root if node is None else node
+        stack = [(node, None, None, False), (node, None, None, True)]
+        while stack:
+            item = stack.pop()
+            yield item
+            if item[3] and (item[0] in self.data):
+                for (g,l) in reversed(self.data[item[0]]):
+                    stack.append((g, item[0], l, False))
+                    stack.append((g, item[0], l, True))
+
+    # The nodes of the subtree, parents before their children
+    def iterPreOrder(self, node=None):
+        return (item[0] for item in self.walk(node) if item[3])
+
+    # The nodes of the subtree, children before their parents
+    def iterPostOrder(self, node=None):
+        return (item[0] for item in self.walk(node) if not item[3])
+
+
 
     # print the tree into the phylTree format (with tabulations)
     def printTree(self, f, node=None):
 
-        def rec(n, node):
-
+        depth = {None: -1}
+        for (node, parent, d, entering) in self.walk(node):
+            if not entering:
+                continue
+            n = depth[node] = depth[parent] + 1
             indent = "\t" * n
+            # length of the branch, under the parent
+            if parent is not None:
+                print("%slen\t%g" % (indent, d), file=f)
             # id of the node
             print("%sid\t%d" % (indent, node), file=f)
             # informations
             print("%sinfo\t{%s}" % (indent, ", ".join(repr(key) + ": " + repr(value) for (key, value) in sorted(self.info[node].items()))), file=f)
-            # children
-            for (g,d) in self.data.get(node,[]):
-                print("%s\tlen\t%g" % (indent, d), file=f)
-                rec(n+1, g)
 
-        rec(0, self.root if node is None else node)
         try:
             f.flush()
         except AttributeError:
@@ -91,55 +124,65 @@ class ProteinTree:
     # print the tree into the Newick format (with parentheses)
     def printNewick(self, f, root=None, withDist=True, withTags=False, withAncSpeciesNames=False, withAncGenesNames=False):
         NHX = [("Duplication", "D"), ("Bootstrap", "B"), ("taxon_name", "S"), ("duplication_confidence_score", "SIS"), ("dubious_duplication", "DD")]
-        def rec(node):
+        # The pieces of the newick string, in order
+        text = []
+        # The nodes that already have a child in the text
+        started = set()
+        for (node, parent, l, entering) in self.walk(root):
+            if entering:
+                if parent in started:
+                    text.append(",")
+                started.add(parent)
+                text.append("(" if node in self.data else self.info[node]['gene_name'].split("/")[0])
+                continue
             if node in self.data:
-                return "(" + ",".join(
-                        rec(g)
-                        + ((":%g" % l) if withDist else "")
-                        + ("[&&NHX:" + ":".join(("%s=%s" % ((tag,self.info[g][key]) if key!="Duplication" else (tag,"N" if self.info[g][key] == 0 else "Y"))).replace(" ", ".") for (key, tag) in NHX if key in self.info[g]) + "]" if withTags else "")
-                        for (g,l) in self.data[node]
-                ) + ")" + (self.info[node]["taxon_name"].replace(' ', '.') if withAncSpeciesNames and ("taxon_name" in self.info[node]) else '')+(self.info[node]['family_name'].split("/")[0]if withAncGenesNames and ("taxon_name" in self.info[node]) else '')
-            else:
-                return self.info[node]['gene_name'].split("/")[0]
+                text.append(")" + (self.info[node]["taxon_name"].replace(' ', '.') if withAncSpeciesNames and ("taxon_name" in self.info[node]) else '')+(self.info[node]['family_name'].split("/")[0]if withAncGenesNames and ("taxon_name" in self.info[node]) else ''))
+            if parent is not None:
+                text.append(((":%g" % l) if withDist else "")
+                        + ("[&&NHX:" + ":".join(("%s=%s" % ((tag,self.info[node][key]) if key!="Duplication" else (tag,"N" if self.info[node][key] == 0 else "Y"))).replace(" ", ".") for (key, tag) in NHX if key in self.info[node]) + "]" if withTags else ""))
 
         if root is None:
             root = self.root
-        print(rec(root) + ("[&&NHX:" + ":".join(("%s=%s" % ((tag,self.info[root][key]) if key!="Duplication" else (tag,"N" if self.info[root][key]== 0 else "Y"))).replace(" ", ".") for (key, tag) in NHX if key in self.info[root]) + "]" if withTags else "") + ";", file=f)
+        print("".join(text) + ("[&&NHX:" + ":".join(("%s=%s" % ((tag,self.info[root][key]) if key!="Duplication" else (tag,"N" if self.info[root][key]== 0 else "Y"))).replace(" ", ".") for (key, tag) in NHX if key in self.info[root]) + "]" if withTags else "") + ";", file=f)
         try:
             f.flush()
         except AttributeError:
             pass
 
 
+    # print the tree in JSON, on a single line: [root, [[node, [[child, length], ...]], ...], [[node, info], ...]]
+    # The nodes are in pre-order
+    def printJSON(self, f, node=None):
+        nodes = list(self.iterPreOrder(node))
+        print(json.dumps([nodes[0], [[n, self.data[n]] for n in nodes if n in self.data], [[n, self.info[n]] for n in nodes]], separators=(",", ":")), file=f)
+        try:
+            f.flush()
+        except AttributeError:
+            pass
+
     #FIXME print tree into the Newick format
     def printNewickTree(self, f, node=None):
         genes = []
-        def rec(node):
+        text = {}
+        for node in self.iterPostOrder(node):
             if node not in self.data:
                 genes.append(self.info[node]['gene_name'])
-                return self.info[node]['gene_name']
+                text[node] = self.info[node]['gene_name']
             else:
-                return "(" + ",".join([rec(x) + ":" + str(l) for (x,l)  in self.data[node]]) + ") " + self.info[node]['family_name']
-        tr = rec(self.root if node is None else node)
+                text[node] = "(" + ",".join([text.pop(x) + ":" + str(l) for (x,l)  in self.data[node]]) + ") " + self.info[node]['family_name']
         print(" ".join(genes), file=f)
-        print(tr, ";", file=f)
+        print(text.popitem()[1], ";", file=f)
 
 
     # Compact a tree by removing intermediary nodes that have only one child
     def compactTree(self, phylTree, node=None):
 
-        def do(node):
-            # end of the process on one leaf
-            if node not in self.data:
-                return False
-
-            flag = False
-            # recursive calls
-            for (gg,_) in self.data[node]:
-                flag |= do(gg)
-
-            if len(self.data[node]) > 1:
-                return flag
+        flag = False
+        # the children are edited before their parents
+        for node in self.iterPostOrder(node):
+            # nothing to do on the leaves and on the nodes with several children
+            if (node not in self.data) or (len(self.data[node]) > 1):
+                continue
 
             # edition of the current node
             (g,l) = self.data[node][0]
@@ -150,32 +193,27 @@ class ProteinTree:
                 del self.data[node]
             self.info[node] = self.info[g]
             del self.info[g]
-            return True
+            flag = True
 
-        return do(self.root if node is None else node)
+        return flag
 
 
     # rename all nodes in order to make them match with the common ancestors of their descendants
     def renameTree(self, phylTree, node=None):
 
-        def do(node):
+        flag = False
+        # the children are renamed before their parents
+        for node in self.iterPostOrder(node):
             # end of the process on one leaf
             if node not in self.data:
-                return False
-
-            flag = False
-            # recursive calls
-            for (g,_) in self.data[node]:
-                flag |= do(g)
+                continue
 
             # rename the current node
             newName = phylTree.lastCommonAncestor( [self.info[g]['taxon_name'] for (g,_) in self.data[node]] )
             flag |= (self.info[node]['taxon_name'] != newName)
             self.info[node]['taxon_name'] = newName
 
-            return flag
-
-        return do(self.root if node is None else node)
+        return flag
 
 
     # Flatten a node and direct children if they represent the same taxon and if their is no duplication
@@ -191,10 +229,6 @@ class ProteinTree:
             assert len(self.data[node]) > 0
 
             flag = False
-            # recursive calls
-            if rec:
-                for (g,_) in self.data[node]:
-                    flag |= do(g)
 
             self.info[node]['taxon_name'] = phylTree.lastCommonAncestor( [self.info[g]['taxon_name'] for (g,_) in self.data[node]] )
 
@@ -230,7 +264,13 @@ class ProteinTree:
 
             return flag
 
-        return do(self.root if node is None else node)
+        if not rec:
+            return do(self.root if node is None else node)
+        flag = False
+        # the children are flattened before their parents
+        for node in self.iterPostOrder(node):
+            flag |= do(node)
+        return flag
 
 
     # give back the expected topology to the tree (to match the species tree)
@@ -290,14 +330,15 @@ class ProteinTree:
                     else:
                         items = list(children.items())
 
-                    newData = set()
+                    # a list, so that the order of the children does not depend on their ids
+                    newData = []
                     for (anc,lst) in items:
                         if len(lst) == 1:
-                            newData.add( lst[0] )
+                            newData.append( lst[0] )
                         elif len(lst) > 1:
                             for (g,l) in self.data[node]:
                                 if (g in self.data) and (self.data[g] == lst):
-                                    newData.add( (g,l) )
+                                    newData.append( (g,l) )
                                     break
                                 if g in self.data:
                                     assert sorted(self.data[g]) != sorted(lst)
@@ -310,20 +351,22 @@ class ProteinTree:
                                 self.info[nextNodeID] = {'taxon_name':anc}
                                 self.info[nextNodeID]["Duplication"] = 1 if hasLowScore(self, nextNodeID) else 3
                                 todo.append(nextNodeID)
-                                newData.add( (nextNodeID,length) )
+                                newData.append( (nextNodeID,length) )
                                 self.flattenTree(phylTree, False,  nextNodeID)
                                 flag = True
                     assert len(newData) == len(set(g for (g,_) in newData)), newData
-                    self.data[node] = [x for x in self.data[node] if x in newData] + list(newData.difference(self.data[node]))
+                    self.data[node] = [x for x in self.data[node] if x in newData] + [x for x in newData if x not in self.data[node]]
                     for x in todo:
                         if hasLowScore(self, x):
                             self.info[x]["Duplication"] = 0
                             self.flattenTree(phylTree, False, x)
-            # recursive calls
-            for (g,_) in self.data[node]:
-                flag |= do(g)
             return flag
-        return do(self.root if node is None else node)
+
+        flag = False
+        # the parents are rebuilt before their (new) children
+        for node in self.iterPreOrder(node):
+            flag |= do(node)
+        return flag
 
 nextNodeID = -1
 
@@ -344,8 +387,38 @@ def getDupSuffix(n, upper=False):
     return s + chr(base + n)
 
 
+# An item of the info dicts written by printTree, whose value is a simple
+# string (without quotes or escapes), an integer, a float or a list of such strings
+infoItem = re.compile(r"'([^'\\]*)': (?:'([^'\\]*)'|(-?[0-9]+)(?=[,}])|(-?[0-9]+\.[0-9]*(?:e[-+][0-9]+)?|-?[0-9]+e[-+][0-9]+)|\[((?:'[^'\\]*'(?:, '[^'\\]*')*)?)\])(, |\}$)")
+infoListItem = re.compile(r"'([^'\\]*)'")
+
+# Parse an info dict written by printTree, without eval(). The dicts that
+# infoItem does not cover are given to ast.literal_eval
+def parseInfo(s):
+    info = {}
+    if s.startswith("{"):
+        if s == "{}":
+            return info
+        m = infoItem.match(s, 1)
+        while m:
+            (key, string, integer, number, strings, sep) = m.groups()
+            if string is not None:
+                info[key] = string
+            elif integer is not None:
+                info[key] = int(integer)
+            elif number is not None:
+                info[key] = float(number)
+            else:
+                info[key] = infoListItem.findall(strings)
+            if sep == "}":
+                return info
+            m = infoItem.match(s, m.end())
+    return ast.literal_eval(s)
+
+
 # load the tree from a file
-def loadPhylTreeTree(f):
+# With a GeneNameRegistry (names), the gene names are replaced with their ids
+def loadPhylTreeTree(f, names=None):
 
     ns = myTools.Namespace()
 
@@ -370,7 +443,9 @@ def loadPhylTreeTree(f):
         # id of the point
         currID = int(nextLine()[2])
         # associated informations
-        tree.info[currID] = eval(nextLine()[2])
+        tree.info[currID] = parseInfo(nextLine()[2])
+        if (names is not None) and ("gene_name" in tree.info[currID]):
+            tree.info[currID]["gene_name"] = names.getId(tree.info[currID]["gene_name"])
 
         # children ?
         child = []
@@ -392,55 +467,193 @@ def loadPhylTreeTree(f):
             break
 
 
-# load the tree from an NHX file
-def loadNHXTree(f):
+# load the trees written by printJSON, one per line
+# With a GeneNameRegistry (names), the gene names are replaced with their ids
+def loadJSONTree(f, names=None):
 
-    import io
+    for line in f:
+        if not line.strip():
+            continue
+        (root, data, info) = json.loads(line)
+        tree = ProteinTree({node: [tuple(x) for x in children] for (node, children) in data}, dict(info), root)
+        if names is not None:
+            for inf in tree.info.values():
+                if "gene_name" in inf:
+                    inf["gene_name"] = names.getId(inf["gene_name"])
+        yield tree
 
-    ns = myTools.Namespace()
-    ns.nodeid = 0
-    ns.ntree = 0
 
-    def convertNodeRec(tree, proteinTree, node):
-        nodeid = ns.nodeid
-        ns.nodeid += 1
+# Tokens of the NHX trees understood by parseNHXLine: punctuation, comments
+# (without nested brackets), words (no quotes) and white spaces
+nhxToken = re.compile(r"([(),;:])|\[([^\[\]]*)\]|([^(),;:\[\]\s']+)|(\s+)")
+nhxProperty = re.compile(r":(?P<key>[^=]+)=(?P<value>[^:]+)")
+
+# Raised by parseNHXLine when the line needs the generic newick parser
+class NHXSyntaxError(ValueError):
+    pass
+
+# Parse a single-line NHX tree straight into a ProteinTree, the nodes being
+# numbered from firstNodeID. Gives the same ProteinTree as the generic newick
+# parser followed by the conversion in loadNHXTree, including the names given
+# by myPhylTree to the unnamed nodes, but only supports the usual syntax.
+# Returns the tree and the next node id
+def parseNHXLine(line, firstNodeID, names=None):
+
+    # Each node is [children, name, length, properties]
+    root = [[], None, None, {}]
+    stack = [root]
+    # Whether the name and the length of the current node have been read
+    seen = [False, False]
+    colon = False
+    end = False
+    pos = 0
+    for m in nhxToken.finditer(line):
+        if m.start() != pos:
+            raise NHXSyntaxError(line)
+        pos = m.end()
+        (punct, comment, word, space) = m.groups()
+        if end:
+            if space is None:
+                raise NHXSyntaxError(line)
+        elif space is not None:
+            raise NHXSyntaxError(line)
+        elif word is not None:
+            if colon and not seen[1]:
+                try:
+                    stack[-1][2] = float(word)
+                except ValueError:
+                    raise NHXSyntaxError(line)
+                seen[1] = True
+            elif not colon and not seen[0]:
+                stack[-1][1] = word
+                seen[0] = True
+            else:
+                raise NHXSyntaxError(line)
+        elif comment is not None:
+            if comment.startswith("&&NHX"):
+                props = stack[-1][3]
+                m = nhxProperty.match(comment, 5)
+                while m:
+                    props[m.group("key")] = m.group("value")
+                    m = nhxProperty.match(comment, m.end())
+            elif comment.startswith("&"):
+                raise NHXSyntaxError(line)
+        elif punct == "(":
+            if seen[0] or seen[1] or colon or stack[-1][0] or stack[-1][3]:
+                raise NHXSyntaxError(line)
+            child = [[], None, None, {}]
+            stack[-1][0].append(child)
+            stack.append(child)
+        elif punct == ",":
+            if len(stack) == 1:
+                raise NHXSyntaxError(line)
+            stack.pop()
+            child = [[], None, None, {}]
+            stack[-1][0].append(child)
+            stack.append(child)
+            (seen, colon) = ([False, False], False)
+            continue
+        elif punct == ")":
+            if len(stack) == 1:
+                raise NHXSyntaxError(line)
+            # "()" would be a leaf for the generic parser
+            last = stack.pop()
+            if (len(stack[-1][0]) == 1) and not (last[0] or seen[0] or seen[1] or colon or last[3]):
+                raise NHXSyntaxError(line)
+            (seen, colon) = ([False, False], False)
+            continue
+        elif punct == ":":
+            if colon:
+                raise NHXSyntaxError(line)
+            colon = True
+        else:
+            if len(stack) != 1:
+                raise NHXSyntaxError(line)
+            end = True
+    if (pos != len(line)) or not end:
+        raise NHXSyntaxError(line)
+
+    # Same numbering and naming as PhylogeneticTree.__loadFromNewick__ and convertNodeRec
+    proteinTree = ProteinTree()
+    usedNames = set()
+    nodeid = firstNodeID
+    ids = {}
+    todo = [root]
+    while todo:
+        node = todo.pop()
+        (children, name, length, props) = node
+        if name in usedNames:
+            name = "NAME_%d" % myPhylTree.nodeIndex
+            myPhylTree.nodeIndex += 1
+        usedNames.add(name)
+        proteinTree.info[nodeid] = convertNHXProperties(props, name, not children, names)
+        ids[id(node)] = nodeid
+        nodeid += 1
+        todo.extend(reversed(children))
+    todo = [root]
+    while todo:
+        node = todo.pop()
+        if node[0]:
+            proteinTree.data[ids[id(node)]] = [(ids[id(child)], 0.0 if child[2] is None else child[2]) for child in node[0]]
+            todo.extend(node[0])
+    proteinTree.root = firstNodeID
+    return (proteinTree, nodeid)
+
+# The info dict of a node of an NHX tree
+def convertNHXProperties(props, name, isLeaf, names=None):
+
+    info = {}
+
+    if "B" in props:
+        info["Bootstrap"] = props["B"]
+
+    if "D" in props:
+        if props["D"] == "N":
+            info["Duplication"] = 0
+        elif props["D"] == "Y":
 
-        info = {}
+            if "SIS" in props:
+                info["duplication_confidence_score"] = float(props["SIS"]) / 100
 
-        if "B" in tree.info[node]:
-            info["Bootstrap"] = tree.info[node]["B"]
+            if "DD" in props and props["DD"] == "Y":
+                info["Duplication"] = 1
+                info["dubious_duplication"] = 1
+            else:
+                info["Duplication"] = 2
+        else:
+            print("Unknown Duplication code '%s'" % (props["D"],), file=sys.stderr)
+            sys.exit(1)
+    else:
+        info["Duplication"] = 0
 
-        if "D" in tree.info[node]:
-            if tree.info[node]["D"] == "N":
-                info["Duplication"] = 0
-            elif tree.info[node]["D"] == "Y":
+    if "E" in props:
+        info["taxon_lost"] = props["E"].split("=-$")[1].split("-")
 
-                if "SIS" in tree.info[node]:
-                    info["duplication_confidence_score"] = float(tree.info[node]["SIS"]) / 100
+    if "S" in props:
+        info["taxon_name"] = props["S"]
 
-                if "DD" in tree.info[node] and tree.info[node]["DD"] == "Y":
-                    info["Duplication"] = 1
-                    info["dubious_duplication"] = 1
-                else:
-                    info["Duplication"] = 2
-            else:
-                print("Unknown Duplication code '%s'" % (tree.info[node]["D"],), file=sys.stderr)
-                sys.exit(1)
-        else:
-            info["Duplication"] = 0
+    if isLeaf:
+        info["gene_name"] = name if names is None else names.getId(name)
+    else:
+        info["node_name"] = name
 
-        if "E" in tree.info[node]:
-            info["taxon_lost"] = tree.info[node]["E"].split("=-$")[1].split("-")
+    return info
 
-        if "S" in tree.info[node]:
-            info["taxon_name"] = tree.info[node]["S"]
+# load the tree from an NHX file
+# With a GeneNameRegistry (names), the gene names are replaced with their ids
+# Most trees are read by parseNHXLine, the others by the generic newick parser
+# The nodes are numbered from firstNodeID, and the trees from firstTreeNumber
+def loadNHXTree(f, names=None, firstNodeID=0, firstTreeNumber=0):
 
-        if node not in tree.items:
-            info["gene_name"] = node
-        else:
-            info["node_name"] = node
+    ns = myTools.Namespace()
+    ns.nodeid = firstNodeID
+    ns.ntree = firstTreeNumber
 
-        proteinTree.info[nodeid] = info
+    def convertNodeRec(tree, proteinTree, node):
+        nodeid = ns.nodeid
+        ns.nodeid += 1
+
+        proteinTree.info[nodeid] = convertNHXProperties(tree.info[node], node, node not in tree.items, names)
         if node in tree.items:
             data = []
             for (e, l) in tree.items[node]:
@@ -453,10 +666,13 @@ def loadNHXTree(f):
             #Do nothing : empty line
             continue
         elif line.find(";\n"):
-            proteinTree = ProteinTree()
-            tree = myPhylTree.PhylogeneticTree(None)
-            tree.__loadFromNewick__(line)
-            proteinTree.root = convertNodeRec(tree, proteinTree, tree.root)
+            try:
+                (proteinTree, ns.nodeid) = parseNHXLine(line, ns.nodeid, names)
+            except NHXSyntaxError:
+                proteinTree = ProteinTree()
+                tree = myPhylTree.PhylogeneticTree(None)
+                tree.__loadFromNewick__(line.strip())
+                proteinTree.root = convertNodeRec(tree, proteinTree, tree.root)
             proteinTree.info[proteinTree.root]["tree_name"] = "Fam%06d" % ns.ntree
             ns.ntree += 1
         else:
@@ -465,22 +681,48 @@ def loadNHXTree(f):
         yield proteinTree
 
 
-def loadTree(name):
-    print("Loading the forest of gene trees %s ..." % name, end=' ', file=sys.stderr)
-    f = myFile.openFile(name, "r") if isinstance(name, str) else name
+# The format of a forest of gene trees, from its first line
+def getTreeFormat(firstLine):
+    if firstLine.startswith('['):
+        return "JSON"
+    elif (';' in firstLine) or ('(' in firstLine):
+        return "NHX"
+    else:
+        return "phylTree"
 
-    # Sniff the first line and choose the appropriate loader
-    # We can't use firstLineBuffer because loadPhylTreeTree uses next()
-    # and the later is not able to add the first line back
-    firstLine = next(f)
-    f.seek(0)
 
-    if (';' in firstLine) or ('(' in firstLine):
-        tree_format = "NHX"
-        loader = loadNHXTree(f)
+# The file is read by a background thread (prefetch=True), so that it is
+# decompressed while the trees are being parsed
+# With trees (tree numbers), only these trees are loaded, using the index of
+# the forest (see ForestIndex), built unless given
+def loadTree(name, names=None, prefetch=True, trees=None, index=None):
+    print("Loading the forest of gene trees %s ..." % name, end=' ', file=sys.stderr)
+    if trees is not None:
+        if index is None:
+            index = ForestIndex(name)
+        tree_format = index.format
+        f = loader = index.loadTrees(trees, names)
     else:
-        tree_format = "phylTree"
-        loader = loadPhylTreeTree(f)
+        if prefetch:
+            # Closing the generator closes the file
+            f = lines = myFile.prefetchLines(name)
+        else:
+            f = myFile.openFile(name, "r")
+            lines = iter(f)
+
+        # Sniff the first line and choose the appropriate loader
+        # The first line is put back in front of the others, rather than rewinding
+        # the file, which would decompress it again (and isn't possible on pipes)
+        firstLine = next(lines)
+        lines = itertools.chain([firstLine], lines)
+
+        tree_format = getTreeFormat(firstLine)
+        if tree_format == "NHX":
+            loader = loadNHXTree(lines, names)
+        elif tree_format == "JSON":
+            loader = loadJSONTree(lines, names)
+        else:
+            loader = loadPhylTreeTree(lines, names)
     print("(%s format)" % tree_format, end=' ', file=sys.stderr)
 
     # Load and count the trees
@@ -493,3 +735,160 @@ def loadTree(name):
 
     f.close()
 
+
+# Iterate over the trees of a forest, without parsing them, from the
+# compressed stream at offset (see myFile.readLinesAt). Yields (offset of the
+# stream, position of the tree in the stream, position of the tree in the
+# forest, lines of the tree)
+def iterTreeLines(forest, tree_format, offset=0, skip=0, position=0):
+    import locale
+    # Like openFile(forest, "r")
+    encoding = locale.getpreferredencoding(False)
+    tree = None
+    for (lineOffset, linePosition, line) in myFile.readLinesAt(forest, offset, skip):
+        text = line.decode(encoding)
+        if tree_format != "phylTree":
+            # One tree per line (see loadNHXTree)
+            start = len(text.replace(" ", "").replace("\n", "")) > 0
+        else:
+            start = text.startswith("id\t")
+        if start:
+            if tree is not None:
+                yield tree
+            tree = (lineOffset, linePosition, position, [text])
+        elif tree is not None:
+            tree[3].append(text)
+        position += len(line)
+    if tree is not None:
+        yield tree
+
+
+# Where a tree starts in the forest (see iterTreeLines), and a summary of its content
+# firstNameIndex is the number of names given to the unnamed nodes of the
+# previous trees (see myPhylTree.nodeIndex)
+ForestIndexEntry = collections.namedtuple("ForestIndexEntry", ["offset", "skip", "position", "firstNodeID", "firstNameIndex", "family", "nbLeaves", "species"])
+
+# Index of a forest of gene trees, to load some of its trees without parsing
+# the whole forest (loadTree(..., trees=...)), or to split the forest into
+# shards. The entries are in the order of the trees. In a compressed forest,
+# a tree is read from the beginning of its compressed stream. A forest
+# written as a series of streams (AGORA_COMPRESSION_THREADS, pbzip2) can be
+# read from anywhere, but a single stream has to be decompressed from the start
+# The index can be saved (in a file chosen by the caller, never next to the
+# forest, whose directory may be read-only or shared) as a tab-separated
+# file: a header with the format, the size and modification time of the
+# forest and the version of the index, then one line per tree with the fields
+# of ForestIndexEntry, the species taking the last columns
+class ForestIndex:
+
+    # Bumped when the fields of the index change
+    version = 2
+
+    # The index saved in filename if it is up to date, otherwise it is built
+    # (and saved in filename if possible). Without filename, it is only built
+    @classmethod
+    def load(cls, forest, filename=None):
+        if not filename:
+            return cls(forest)
+        st = os.stat(forest)
+        try:
+            f = myFile.openFile(filename, "r")
+        except OSError:
+            pass
+        else:
+            header = next(f, "").rstrip("\n").split("\t")
+            if header[1:] == [str(st.st_size), str(st.st_mtime_ns), str(cls.version)]:
+                index = object.__new__(cls)
+                index.forest = forest
+                index.format = header[0][1:]
+                index.nameIndex = myPhylTree.nodeIndex
+                index.entries = []
+                for l in f:
+                    t = l.rstrip("\n").split("\t")
+                    index.entries.append(ForestIndexEntry(int(t[0]), int(t[1]), int(t[2]), int(t[3]), int(t[4]), t[5], int(t[6]), frozenset(t[7:])))
+                f.close()
+                return index
+            f.close()
+        index = cls(forest)
+        try:
+            index.save(filename)
+        except OSError:
+            pass
+        return index
+
+    # Build the index by reading the whole forest
+    # The names given to the unnamed nodes continue from the current
+    # myPhylTree.nodeIndex, which is left unchanged
+    def __init__(self, forest):
+        print("Indexing the forest of gene trees %s ..." % forest, end=' ', file=sys.stderr)
+        self.forest = forest
+        self.nameIndex = myPhylTree.nodeIndex
+        self.entries = []
+        firstLine = next(myFile.readLinesAt(forest), (0, 0, b""))[2]
+        self.format = getTreeFormat(firstLine.decode(errors="replace"))
+        nodeid = 0
+        try:
+            for (offset, skip, position, lines) in iterTreeLines(forest, self.format):
+                nameIndex = myPhylTree.nodeIndex - self.nameIndex
+                tree = self.parseTree(lines, nodeid, len(self.entries))
+                leaves = [node for node in tree.info if node not in tree.data]
+                species = frozenset(tree.info[node]["taxon_name"] for node in leaves if "taxon_name" in tree.info[node])
+                self.entries.append(ForestIndexEntry(offset, skip, position, nodeid, nameIndex, tree.info[tree.root].get("tree_name", ""), len(leaves), species))
+                nodeid += len(tree.info)
+        finally:
+            myPhylTree.nodeIndex = self.nameIndex
+        print(len(self.entries), "trees OK", file=sys.stderr)
+
+    def parseTree(self, lines, firstNodeID, number, names=None):
+        if self.format == "NHX":
+            return next(loadNHXTree(lines, names, firstNodeID, number))
+        elif self.format == "JSON":
+            return next(loadJSONTree(lines, names))
+        else:
+            return next(loadPhylTreeTree(iter(lines), names))
+
+    # Written atomically, as several scripts may build the same index
+    def save(self, filename):
+        st = os.stat(self.forest)
+        tmpName = "%s.%d.tmp" % (filename, os.getpid())
+        f = myFile.openFile(tmpName, "w")
+        print("#%s\t%d\t%d\t%d" % (self.format, st.st_size, st.st_mtime_ns, self.version), file=f)
+        for e in self.entries:
+            print(myFile.myTSV.printLine(e[:7] + tuple(sorted(e.species))), file=f)
+        f.close()
+        os.replace(tmpName, filename)
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Load the trees with these numbers, in the order of the forest. The trees
+    # are numbered and named as if the whole forest was loaded from the point
+    # where the index was loaded
+    def loadTrees(self, trees, names=None):
+        reader = None
+        for number in sorted(set(trees)):
+            e = self.entries[number]
+            # Reading forward is cheaper than restarting from the stream of the tree
+            if (reader is None) or not (position <= e.position <= position + e.skip):
+                reader = iterTreeLines(self.forest, self.format, e.offset, e.skip, e.position)
+            for (_, _, position, lines) in reader:
+                if position == e.position:
+                    break
+            myPhylTree.nodeIndex = self.nameIndex + e.firstNameIndex
+            yield self.parseTree(lines, e.firstNodeID, number, names)
+
+    # Split the forest into (at most) nbShards ranges of consecutive trees
+    # with about the same number of leaves
+    def getShards(self, nbShards):
+        # Each tree counts for one more leaf, so that there are no empty trees
+        total = sum(e.nbLeaves + 1 for e in self.entries)
+        shards = []
+        (start, cumul) = (0, 0)
+        for (i, e) in enumerate(self.entries):
+            cumul += e.nbLeaves + 1
+            if cumul * nbShards >= total * (len(shards) + 1):
+                shards.append(range(start, i + 1))
+                start = i + 1
+        if start < len(self.entries):
+            shards.append(range(start, len(self.entries)))
+        return shards
@@ -70,6 +70,21 @@ class FileOrPatternArgChecker(ArgChecker):
         else:
             return FileArgChecker.check(value)
 
+# Amount of memory, e.g. 512M, 16G, 1.5T. Plain numbers are in MB. Returns bytes
+class MemorySizeArgChecker(ArgChecker):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    @classmethod
+    def check(cls, value):
+        s = value.strip().upper().rstrip("B")
+        unit = cls.units["M"]
+        if s and s[-1] in cls.units:
+            unit = cls.units[s[-1]]
+            s = s[:-1]
+        try:
+            return int(float(s) * unit)
+        except ValueError:
+            raise ValueError("'%s' is not a valid amount of memory" % value)
+
 file = FileArgChecker
 
 
@@ -330,6 +345,85 @@ def getRange(s):
         return list(range(int(start), int(end)+1))
 
 
+# Number of threads the workflow currently allows a multithreaded step to use
+# (cooperative protocol, see TaskList in myAgoraWorkflow)
+threadsFileVariable = "AGORA_THREADS_FILE"
+
+def readThreadsFile(fileName, default):
+    try:
+        with open(fileName, "r") as f:
+            return max(1, int(f.read()))
+    except (OSError, ValueError):
+        return default
+
+# Equivalent of multiprocessing.Pool(nbThreads).map(func, items)
+# When run by the workflow, the number of items processed at the same time
+# follows the number of threads given to the step, which can change while
+# the step is running
+def dynamicPoolMap(func, items, nbThreads):
+    import gc
+    # The objects loaded so far (e.g. the genomes) are hidden from the garbage
+    # collector (Python >= 3.7). Otherwise its collections in every forked process
+    # write to all of them, which copies all their memory pages in each process
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    try:
+        return _dynamicPoolMap(func, items, nbThreads)
+    finally:
+        if hasattr(gc, "unfreeze"):
+            gc.unfreeze()
+
+def _dynamicPoolMap(func, items, nbThreads):
+    import multiprocessing
+    import queue
+    threadsFile = os.environ.get(threadsFileVariable)
+    if not threadsFile:
+        return multiprocessing.Pool(nbThreads).map(func, items)
+    items = list(items)
+    results = [None] * len(items)
+    done = queue.Queue()
+    # The worker processes are only started when the step is given the
+    # threads, in a new pool every time it gets more
+    pools = []
+    sizes = []
+    # Number of items running in each pool
+    running = []
+    nextItem = 0
+    try:
+        while (nextItem < len(items)) or sum(running):
+            nbThreads = readThreadsFile(threadsFile, nbThreads)
+            extra = min(nbThreads, len(items)) - sum(sizes)
+            if extra > 0:
+                pools.append(multiprocessing.Pool(extra))
+                sizes.append(extra)
+                running.append(0)
+            # Running items are never interrupted: the step shrinks as they finish
+            while (nextItem < len(items)) and (sum(running) < nbThreads):
+                p = next(p for p in range(len(pools)) if running[p] < sizes[p])
+                pools[p].apply_async(func, (items[nextItem],),
+                        callback=lambda r, i=nextItem, p=p: done.put((i, p, r, None)),
+                        error_callback=lambda e, i=nextItem, p=p: done.put((i, p, None, e)))
+                nextItem += 1
+                running[p] += 1
+            try:
+                # Regularly check whether the number of threads has changed
+                (i, p, r, e) = done.get(timeout=1)
+            except queue.Empty:
+                continue
+            running[p] -= 1
+            if e is not None:
+                raise e
+            results[i] = r
+    except BaseException:
+        for pool in pools:
+            pool.terminate()
+        raise
+    for pool in pools:
+        pool.close()
+        pool.join()
+    return results
+
+
 # hashable dict class, useful to use it as a key
 class hashabledict(dict):
     def __hash__(self):